@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+"""Online quench and anomaly detection for the acquisition loops.
+
+The detector is fed one sample at a time from the monitoring loops in
+control.py, at O(1) cost per sample, and returns the anomalies detected on
+that very sample, so that the caller can react (e.g., stop the power supply
+ramp or save buffered data) within one sample period.
+
+Anomalies detected:
+current_step: the power supply output current changes faster than the ramp
+              segment rate allows (see magnet.RAMP_SEGMENTS)
+voltage_spike: the power supply output voltage deviates from its rolling mean
+               by more than a threshold number of standard deviations
+temperature_spike: same as voltage_spike, for the thermometer temperature
+stuck_reading: the lock-in reading has repeated exactly for a number of
+               consecutive samples
+
+Classes:
+Anomaly: namedtuple (kind, timestamp, value, message)
+RollingStatistics: mean and standard deviation over a sliding window
+AnomalyDetector: streaming detector for power supply and lock-in samples
+
+Functions:
+simulate_ramp: simulate power supply current readings of a normal ramp
+
+When executed directly, this module checks that normal ramps at the ramp
+segment rates (see magnet.RAMP_SEGMENTS), up through every ramp segment
+boundary and back down, raise no anomaly.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import math
+import sys
+
+import magnet
+
+Anomaly = collections.namedtuple('Anomaly',
+                                 ['kind', 'timestamp', 'value', 'message'])
+
+class RollingStatistics(object):
+    """Mean and standard deviation over a sliding window, O(1) per sample.
+
+    Running sums are kept relative to the first sample pushed, to limit
+    cancellation when the spread is small compared to the values.
+    """
+
+    def __init__(self, window):
+        """RollingStatistics class constructor.
+
+        Arguments:
+        window: number of most recent samples the statistics are computed over
+        """
+        self.window = window
+        self._samples = collections.deque()
+        self._shift = None
+        self._sum = 0.0
+        self._sum_sq = 0.0
+
+    def __len__(self):
+        return len(self._samples)
+
+    def full(self):
+        """Return True if the window is filled."""
+        return len(self._samples) >= self.window
+
+    def push(self, value):
+        """Push a sample, dropping the oldest one if the window is full."""
+        if self._shift is None:
+            self._shift = value
+        value -= self._shift
+        self._samples.append(value)
+        self._sum += value
+        self._sum_sq += value * value
+        if len(self._samples) > self.window:
+            oldest = self._samples.popleft()
+            self._sum -= oldest
+            self._sum_sq -= oldest * oldest
+
+    def mean(self):
+        """Mean of the samples in the window."""
+        return self._sum / len(self._samples) + self._shift
+
+    def std(self):
+        """Standard deviation of the samples in the window."""
+        count = len(self._samples)
+        mean = self._sum / count
+        return math.sqrt(max(self._sum_sq / count - mean * mean, 0.0))
+
+class AnomalyDetector(object):
+    """Streaming detector for power supply and lock-in samples.
+
+    Each check_* method takes one sample and returns a (possibly empty) list of
+    Anomaly instances detected on that sample.
+
+    Attributes:
+    ramp_segments: list of tuples (CURRENT, RATE), as passed to
+                   gpib.PowerSupply.set_ramp_segments_params
+    rate_margin: factor by which the ramp segment rate may be exceeded
+    current_resolution: current reading resolution (in A), tolerated as a step
+                        on top of the ramp rate
+    spike_threshold: number of rolling standard deviations beyond which a
+                     voltage or temperature sample is a spike
+    stuck_count: number of identical consecutive lock-in readings considered
+                 stuck
+    """
+
+    def __init__(self, ramp_segments, window=50, rate_margin=1.5,
+                 current_resolution=1E-3, spike_threshold=8.0,
+                 min_voltage_spread=1E-3, min_temperature_spread=1E-3,
+                 stuck_count=50):
+        """AnomalyDetector class constructor.
+
+        Arguments:
+        ramp_segments: list of tuples (CURRENT, RATE); see
+                       gpib.PowerSupply.set_ramp_segments_params
+        window: number of samples of the rolling statistics; defaults to 50
+        rate_margin: defaults to 1.5
+        current_resolution: defaults to 1E-3
+        spike_threshold: defaults to 8.0
+        min_voltage_spread: lower bound on the rolling standard deviation of
+                            the output voltage (in V), so that a perfectly
+                            steady voltage does not make every fluctuation a
+                            spike; defaults to 1E-3
+        min_temperature_spread: same as min_voltage_spread, for the temperature
+                                (in K); defaults to 1E-3
+        stuck_count: defaults to 50
+        """
+        self.ramp_segments = sorted(ramp_segments)
+        self.rate_margin = rate_margin
+        self.current_resolution = current_resolution
+        self.spike_threshold = spike_threshold
+        self.stuck_count = stuck_count
+        self._min_voltage_spread = min_voltage_spread
+        self._min_temperature_spread = min_temperature_spread
+        self._last_current = None
+        self._voltage_stats = RollingStatistics(window)
+        self._temperature_stats = RollingStatistics(window)
+        self._last_reading = None
+        self._repeats = 0
+
+    def _ramp_rate(self, current):
+        """Ramp segment rate (in A/s) in effect at current."""
+        for limit, rate in self.ramp_segments:
+            if abs(current) <= limit:
+                return rate
+        return self.ramp_segments[-1][1]
+
+    def _check_spike(self, stats, min_spread, kind, timestamp, value, unit):
+        """Check value against the rolling statistics, then push it."""
+        anomalies = []
+        if stats.full():
+            mean = stats.mean()
+            spread = max(stats.std(), min_spread)
+            if abs(value - mean) > self.spike_threshold * spread:
+                anomalies.append(Anomaly(
+                    kind, timestamp, value,
+                    "%s: %.4g %s against rolling mean %.4g %s" %
+                    (kind.replace('_', ' '), value, unit, mean, unit)))
+        stats.push(value)
+        return anomalies
+
+    def check_current(self, timestamp, current):
+        """Check a power supply output current sample (in A)."""
+        anomalies = []
+        if self._last_current is not None:
+            last_timestamp, last_current = self._last_current
+            interval = timestamp - last_timestamp
+            if interval > 0:
+                step = abs(current - last_current)
+                # a step across a segment boundary may run at the faster rate
+                # of the two segments
+                rate = max(self._ramp_rate(abs(current)),
+                           self._ramp_rate(abs(last_current)))
+                allowed = rate * self.rate_margin * interval + \
+                    self.current_resolution
+                if step > allowed:
+                    anomalies.append(Anomaly(
+                        'current_step', timestamp, current,
+                        "current step: %.4f A in %.3f s exceeds ramp rate "
+                        "%.4f A/s" % (current - last_current, interval, rate)))
+        self._last_current = (timestamp, current)
+        return anomalies
+
+    def check_voltage(self, timestamp, voltage):
+        """Check a power supply output voltage sample (in V)."""
+        return self._check_spike(self._voltage_stats, self._min_voltage_spread,
+                                 'voltage_spike', timestamp, voltage, 'V')
+
+    def check_lock_in(self, timestamp, reading, temperature=None):
+        """Check a lock-in sample.
+
+        Arguments:
+        timestamp: timestamp of the sample
+        reading: raw lock-in reading (in V), checked for stuck readings
+        temperature: temperature (in K) converted from reading, checked for
+                     spikes; defaults to None, i.e., out of range, not checked
+        """
+        anomalies = []
+        if reading == self._last_reading:
+            self._repeats += 1
+            if self._repeats == self.stuck_count:
+                anomalies.append(Anomaly(
+                    'stuck_reading', timestamp, reading,
+                    "stuck reading: %.4E V repeated %d times" %
+                    (reading, self._repeats)))
+        else:
+            self._last_reading = reading
+            self._repeats = 1
+        if temperature is not None:
+            anomalies.extend(self._check_spike(
+                self._temperature_stats, self._min_temperature_spread,
+                'temperature_spike', timestamp, temperature, 'K'))
+        return anomalies
+
+def simulate_ramp(ramp_segments, start, target, sampling_interval=0.1,
+                  resolution=1E-4, substeps=100):
+    """Simulate power supply current readings of a normal ramp.
+
+    The current changes at the rate of the ramp segment it is in, as set with
+    gpib.PowerSupply.set_ramp_segments_params, and is read every
+    sampling_interval. Return value is a list of tuples (TIMESTAMP, CURRENT),
+    from timestamp 0 until the target is reached.
+
+    Arguments:
+    ramp_segments: list of tuples (CURRENT, RATE)
+    start: initial current (in A)
+    target: target current (in A)
+    sampling_interval: interval (in seconds) between readings; defaults to 0.1
+    resolution: resolution (in A) of the readings; defaults to 1E-4
+    substeps: number of integration steps per sampling interval; defaults to
+              100
+    """
+    segments = sorted(ramp_segments)
+    def rate(current, direction):
+        # at a boundary, the segment the current is moving into applies
+        for limit, segment_rate in segments:
+            if abs(current) < limit or (abs(current) == limit and
+                                        direction * current < 0):
+                return segment_rate
+        return segments[-1][1]
+
+    step = sampling_interval / substeps
+    direction = 1 if target >= start else -1
+    current = start
+    timestamp = 0.0
+    readings = [(timestamp, round(current / resolution) * resolution)]
+    while current != target:
+        for _ in range(substeps):
+            current += direction * rate(current, direction) * step
+            if direction * (current - target) >= 0:
+                current = target
+                break
+        timestamp += sampling_interval
+        readings.append((timestamp, round(current / resolution) * resolution))
+    return readings
+
+def main():
+    """CLI interface."""
+    parser = argparse.ArgumentParser(
+        description="Check that normal current ramps raise no anomaly.")
+    parser.add_argument('-s', '--sampling-interval', type=float, default=0.1,
+                        help="interval (in seconds) between current readings; "
+                        "defaults to %(default)s")
+    args = parser.parse_args()
+
+    limits = sorted(limit for limit, _ in magnet.RAMP_SEGMENTS)
+    # just past the last boundary below the top segment
+    top = limits[-2] + 0.01
+    for start, target in [(0.0, top), (top, 0.0)]:
+        detector = AnomalyDetector(magnet.RAMP_SEGMENTS)
+        anomalies = []
+        for timestamp, current in simulate_ramp(
+                magnet.RAMP_SEGMENTS, start, target, args.sampling_interval):
+            anomalies += detector.check_current(timestamp, current)
+        sys.stdout.write("ramp %.2f A -> %.2f A: %d anomalies\n" %
+                         (start, target, len(anomalies)))
+        for event in anomalies:
+            sys.stdout.write("  %.1f s: %s\n" % (event.timestamp,
+                                                  event.message))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+
+"""Batch processing of whole run directories.
+
+A run consists of a lock-in log (lock-in-<epoch>.log) and a power supply log
+(power-supply-<epoch>.log), as written by control.py. The two monitors are
+started by hand a few seconds apart, so logs are paired by the nearest epoch
+within a tolerance. Runs are then processed in parallel across a process pool,
+and one row of summary statistics per run is written to a consolidated results
+table (CSV). Detected ramp segments can optionally be written to a second
+table.
+
+Functions:
+discover_runs: find and pair lock-in and power supply logs in a directory
+read_log: read a log file into timestamp and value arrays
+temperatures: convert lock-in voltages to temperatures
+find_ramps: find ramp segments in a power supply current series
+process_run: compute series, ramp segments and summary statistics of a run
+process_runs: process a list of runs across a process pool
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import csv
+import multiprocessing
+import os
+import re
+import sys
+
+import numpy as np
+
+import magnet
+import v2t
+
+# maximum difference (in seconds) between the epochs of paired logs
+PAIRING_TOLERANCE = 60
+
+_LOG_PATTERN = re.compile(r'^(lock-in|power-supply)-(\d+)\.log$')
+
+SUMMARY_FIELDS = [
+    'run', 'lock_in_file', 'power_supply_file', 'start', 'duration',
+    'lock_in_samples', 'power_supply_samples', 'out_of_range_samples',
+    'min_temperature', 'max_temperature', 'final_temperature',
+    'max_current', 'max_field', 'ramps'
+]
+
+RAMP_FIELDS = [
+    'run', 'start', 'end', 'start_current', 'end_current', 'rate',
+    'start_temperature', 'end_temperature'
+]
+
+def discover_runs(directory, tolerance=PAIRING_TOLERANCE):
+    """Find and pair lock-in and power supply logs in a directory.
+
+    Each lock-in log is paired with the power supply log of the nearest epoch,
+    provided the epochs differ by no more than tolerance seconds and the power
+    supply log has not been claimed by a closer lock-in log. Logs left unpaired
+    form runs of their own.
+
+    Return value is a list of dicts with keys 'run' (the earliest epoch of the
+    run), 'lock_in' and 'power_supply' (paths, or None if missing), sorted by
+    run.
+
+    Arguments:
+    directory: directory to search (not recursively)
+    tolerance: maximum difference (in seconds) between paired epochs; defaults
+               to PAIRING_TOLERANCE
+    """
+    logs = {'lock-in': {}, 'power-supply': {}}
+    for filename in os.listdir(directory):
+        match = _LOG_PATTERN.match(filename)
+        if match is not None:
+            kind, epoch = match.group(1), int(match.group(2))
+            logs[kind][epoch] = os.path.join(directory, filename)
+
+    # greedily pair the closest epochs first
+    candidates = sorted((abs(li_epoch - ps_epoch), li_epoch, ps_epoch)
+                        for li_epoch in logs['lock-in']
+                        for ps_epoch in logs['power-supply']
+                        if abs(li_epoch - ps_epoch) <= tolerance)
+    li_paired = set()
+    ps_paired = set()
+    runs = []
+    for _, li_epoch, ps_epoch in candidates:
+        if li_epoch in li_paired or ps_epoch in ps_paired:
+            continue
+        li_paired.add(li_epoch)
+        ps_paired.add(ps_epoch)
+        runs.append({'run': min(li_epoch, ps_epoch),
+                     'lock_in': logs['lock-in'][li_epoch],
+                     'power_supply': logs['power-supply'][ps_epoch]})
+    for li_epoch in set(logs['lock-in']) - li_paired:
+        runs.append({'run': li_epoch,
+                     'lock_in': logs['lock-in'][li_epoch],
+                     'power_supply': None})
+    for ps_epoch in set(logs['power-supply']) - ps_paired:
+        runs.append({'run': ps_epoch,
+                     'lock_in': None,
+                     'power_supply': logs['power-supply'][ps_epoch]})
+    runs.sort(key=lambda run: run['run'])
+    return runs
+
+def read_log(logfilename):
+    """Read a log file into timestamp and value arrays.
+
+    Only the first two columns (timestamp and value) are used. Return value is
+    a tuple of two numpy arrays, which are empty if the log is empty.
+    """
+    with open(logfilename) as logfile:
+        rows = [line.strip().split(',')[:2] for line in logfile
+                if line.strip()]
+    if not rows:
+        return np.empty(0), np.empty(0)
+    data = np.array(rows, dtype=float)
+    return data[:, 0], data[:, 1]
+
+def temperatures(voltages):
+    """Convert lock-in voltages to temperatures (in K).
+
+    Voltages out of the range accepted by v2t.v2t are converted to NaN.
+    """
+    result = np.empty(len(voltages))
+    for i, voltage in enumerate(voltages):
+        try:
+            result[i] = v2t.v2t(voltage)
+        except AssertionError:
+            result[i] = np.nan
+    return result
+
+def find_ramps(timestamps, currents, min_rate=0.005, min_change=0.01,
+               max_gap=2.0):
+    """Find ramp segments in a power supply current series.
+
+    A ramp segment is a stretch of time during which the current changes
+    monotonically at a rate of at least min_rate. Stretches of the same
+    direction separated by no more than max_gap seconds (e.g., repeated
+    readings during a slow ramp) are merged, and segments with a total change
+    smaller than min_change are discarded.
+
+    Return value is a list of tuples (START_INDEX, END_INDEX, RATE), where
+    RATE is the average ramp rate (in A/s) over the segment.
+
+    Arguments:
+    timestamps: numpy array of timestamps (in seconds)
+    currents: numpy array of currents (in A)
+    min_rate: minimum ramp rate (in A/s); defaults to 0.005
+    min_change: minimum change of current (in A); defaults to 0.01
+    max_gap: maximum gap (in seconds) bridged within a segment; defaults to 2.0
+    """
+    if len(timestamps) < 2:
+        return []
+    intervals = np.diff(timestamps)
+    intervals[intervals <= 0] = np.nan
+    rates = np.diff(currents) / intervals
+    directions = np.where(np.abs(rates) >= min_rate, np.sign(rates), 0)
+
+    segments = []
+    start = end = None
+    direction = 0
+    for i, step in enumerate(directions):
+        if step == 0:
+            continue
+        if (step == direction and
+                timestamps[i] - timestamps[end] <= max_gap):
+            end = i + 1
+            continue
+        if start is not None:
+            segments.append((start, end))
+        start, end, direction = i, i + 1, step
+    if start is not None:
+        segments.append((start, end))
+
+    ramps = []
+    for start, end in segments:
+        change = currents[end] - currents[start]
+        if abs(change) >= min_change:
+            ramps.append((start, end,
+                          change / (timestamps[end] - timestamps[start])))
+    return ramps
+
+def _interpolate(timestamps, values, timestamp):
+    """Interpolate a series at timestamp; NaN outside its time span."""
+    if len(timestamps) == 0:
+        return np.nan
+    return np.interp(timestamp, timestamps, values, left=np.nan,
+                     right=np.nan)
+
+def process_run(run):
+    """Compute series, ramp segments and summary statistics of a run.
+
+    Return value is a tuple (SUMMARY, RAMPS), where SUMMARY is a dict keyed by
+    SUMMARY_FIELDS and RAMPS is a list of dicts keyed by RAMP_FIELDS. Missing
+    quantities are NaN.
+
+    Arguments:
+    run: a dict as returned by discover_runs
+    """
+    if run['lock_in'] is not None:
+        li_time, voltage = read_log(run['lock_in'])
+    else:
+        li_time, voltage = np.empty(0), np.empty(0)
+    if run['power_supply'] is not None:
+        ps_time, current = read_log(run['power_supply'])
+    else:
+        ps_time, current = np.empty(0), np.empty(0)
+
+    temperature = temperatures(voltage)
+    field = current * magnet.MAGNETIC_FIELD_CONSTANT
+    valid = temperature[~np.isnan(temperature)]
+    timestamps = np.concatenate([li_time, ps_time])
+
+    ramps = []
+    for start, end, rate in find_ramps(ps_time, current):
+        ramps.append({
+            'run': run['run'],
+            'start': ps_time[start],
+            'end': ps_time[end],
+            'start_current': current[start],
+            'end_current': current[end],
+            'rate': rate,
+            'start_temperature': _interpolate(li_time, temperature,
+                                              ps_time[start]),
+            'end_temperature': _interpolate(li_time, temperature,
+                                            ps_time[end]),
+        })
+
+    summary = {
+        'run': run['run'],
+        'lock_in_file': run['lock_in'] and os.path.basename(run['lock_in']),
+        'power_supply_file': (run['power_supply'] and
+                              os.path.basename(run['power_supply'])),
+        'start': timestamps.min() if len(timestamps) else np.nan,
+        'duration': (timestamps.max() - timestamps.min()
+                     if len(timestamps) else np.nan),
+        'lock_in_samples': len(li_time),
+        'power_supply_samples': len(ps_time),
+        'out_of_range_samples': len(temperature) - len(valid),
+        'min_temperature': valid.min() if len(valid) else np.nan,
+        'max_temperature': valid.max() if len(valid) else np.nan,
+        'final_temperature': valid[-1] if len(valid) else np.nan,
+        'max_current': current.max() if len(current) else np.nan,
+        'max_field': field.max() if len(field) else np.nan,
+        'ramps': len(ramps),
+    }
+    return summary, ramps
+
+def _process_run_safely(run):
+    """Wrap process_run for the pool, returning the error instead of raising."""
+    try:
+        return run, process_run(run), None
+    except Exception as err:
+        return run, None, "%s: %s" % (type(err).__name__, str(err))
+
+def process_runs(runs, processes=None, calibration=None):
+    """Process a list of runs across a process pool.
+
+    Runs that fail to process are reported to stderr and skipped. Return value
+    is a tuple (SUMMARIES, RAMPS) of lists of dicts, in the order of runs.
+
+    Arguments:
+    runs: a list of dicts as returned by discover_runs
+    processes: number of worker processes; defaults to the number of CPUs
+    calibration: calibration file (see v2t.load_calibration) loaded by every
+                 worker, which must be valid; defaults to None, i.e., the
+                 vendor calibration
+    """
+    summaries = []
+    ramps = []
+    if calibration is None:
+        pool = multiprocessing.Pool(processes)
+    else:
+        pool = multiprocessing.Pool(processes, v2t.load_calibration,
+                                    (calibration,))
+    try:
+        for run, result, error in pool.imap(_process_run_safely, runs):
+            if error is not None:
+                sys.stderr.write("error: failed to process run %d: %s\n" %
+                                 (run['run'], error))
+                continue
+            summaries.append(result[0])
+            ramps.extend(result[1])
+    finally:
+        pool.close()
+        pool.join()
+    return summaries, ramps
+
+def _write_table(rows, fields, output):
+    """Write a list of dicts as CSV, with NaN and None written as blanks."""
+    writer = csv.writer(output)
+    writer.writerow(fields)
+    for row in rows:
+        cells = []
+        for field in fields:
+            value = row[field]
+            if value is None or (isinstance(value, float) and
+                                 np.isnan(value)):
+                cells.append('')
+            elif field in ('start', 'end'):
+                cells.append('%.4f' % value)
+            elif isinstance(value, float):
+                cells.append('%.6g' % value)
+            else:
+                cells.append(value)
+        writer.writerow(cells)
+
+def main():
+    """CLI interface."""
+    parser = argparse.ArgumentParser(
+        description="Batch process lock-in and power supply logs.")
+    parser.add_argument('directory', help="directory containing the logs")
+    parser.add_argument('file', nargs='?',
+                        help="output file for the results table; if not "
+                        "given, write to stdout")
+    parser.add_argument('-r', '--ramps', metavar='FILE',
+                        help="also write ramp segments to FILE")
+    parser.add_argument('-j', '--processes', type=int,
+                        help="number of worker processes; defaults to the "
+                        "number of CPUs")
+    parser.add_argument('-t', '--tolerance', type=float,
+                        default=PAIRING_TOLERANCE,
+                        help="maximum difference (in seconds) between the "
+                        "epochs of paired logs; defaults to %(default)s")
+    parser.add_argument('-c', '--calibration',
+                        help="thermometer calibration file written by "
+                        "calibrate.py")
+    args = parser.parse_args()
+
+    if args.calibration is not None:
+        # checked here, as workers failing to load it would be respawned by
+        # the pool forever
+        try:
+            v2t.load_calibration(args.calibration)
+        except (IOError, OSError, ValueError, KeyError, AssertionError) as err:
+            sys.stderr.write(type(err).__name__ + ": " + str(err) + "\n")
+            sys.stderr.write("error: invalid calibration file\n")
+            return
+    try:
+        runs = discover_runs(args.directory, args.tolerance)
+    except (IOError, OSError) as err:
+        sys.stderr.write(type(err).__name__ + ": " + str(err) + "\n")
+        sys.stderr.write("error: invalid data directory\n")
+        return
+    sys.stderr.write("processing %d runs\n" % len(runs))
+    summaries, ramps = process_runs(runs, args.processes, args.calibration)
+
+    try:
+        if args.file is None:
+            _write_table(summaries, SUMMARY_FIELDS, sys.stdout)
+        else:
+            with open(args.file, 'w') as output:
+                _write_table(summaries, SUMMARY_FIELDS, output)
+        if args.ramps is not None:
+            with open(args.ramps, 'w') as output:
+                _write_table(ramps, RAMP_FIELDS, output)
+    except (IOError, OSError) as err:
+        sys.stderr.write(type(err).__name__ + ": " + str(err) + "\n")
+        sys.stderr.write("error: invalid output file\n")
+
+if __name__ == "__main__":
+    main()
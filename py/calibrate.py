@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+
+"""Refit thermometer calibration from curve data.
+
+This module fits multi-band Chebychev series of log10(T) in z = log10(R) to
+the breakpoint table of a Lake Shore curve file (e.g., 'Rx202aMN.340', format
+4, log ohms/kelvin), in the form of the vendor series of T hardcoded in
+r2t.py. Fits are checked between breakpoints as well, on a dense
+grid, against the range the curve is known to lie in there, so that
+oscillations of high-order series are caught and the interpolation
+uncertainty of sparse breakpoints counts as error. Band boundaries are chosen
+greedily, favoring more bands of lower order; within each band, the lowest
+order meeting the relative error target (plus half the resolution of the
+breakpoint temperatures) is used, so that conversions are as cheap as the
+error target permits. Ranges where the breakpoints do not permit the error
+target get a single band with the smallest error found, and are reported.
+
+Optionally, reference points (resistance of our thermometer at a known
+temperature) are used to fit the resistance scaling factor of v2t.py by least
+squares in log resistance, replacing the single-point 2929/2896 correction.
+
+The resulting calibration is written as a JSON file that can be loaded at
+runtime with r2t.load_calibration or v2t.load_calibration.
+
+Functions:
+read_curve: read the breakpoint table of a Lake Shore curve file
+fit_band: fit a series of the lowest sufficient order to a band
+fit_bands: choose band boundaries and fit each band
+fit_scaling_factor: fit the resistance scaling factor to reference points
+calibration: assemble a calibration for r2t.load_calibration
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+
+import numpy as np
+from numpy.polynomial import chebyshev
+
+# relative temperature error target
+ERROR_TARGET = 1E-3
+
+# maximum order of the Chebychev series in each band
+MAX_ORDER = 8
+
+# number of subdivisions of each breakpoint interval on which fits are checked
+_SUBDIVISIONS = 20
+
+def read_curve(curvefilename):
+    """Read the breakpoint table of a Lake Shore curve file.
+
+    Only data format 4 (log ohms/kelvin) is supported. Return value is a tuple
+    of two numpy arrays (Z, T), sorted in ascending order of Z = log10(R).
+    """
+    header = {}
+    breakpoints = []
+    with open(curvefilename) as curvefile:
+        for line in curvefile:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                header[key.strip()] = value.split()[0] if value.split() else ''
+                continue
+            fields = line.split()
+            if len(fields) != 3:
+                continue
+            try:
+                breakpoints.append((float(fields[1]), float(fields[2])))
+            except ValueError:
+                # column headings
+                continue
+    data_format = header.get('Data Format')
+    assert data_format == '4', \
+        "unsupported data format %s in %s" % (data_format, curvefilename)
+    assert len(breakpoints) > 1, "no breakpoints in %s" % curvefilename
+    z, t = np.array(sorted(breakpoints)).T
+    return z, t
+
+def _normalize(z, zl, zu):
+    """Map z in [zl, zu] onto [-1, 1], as in r2t._chebychev_series."""
+    return ((z - zl) - (zu - z)) / (zu - zl)
+
+def _dense_reference(z, t, subdivisions=_SUBDIVISIONS):
+    """Bracket the curve between breakpoints on a dense grid.
+
+    Every breakpoint interval is subdivided, and the curve is bracketed by the
+    breakpoints interpolated linearly in log temperature and linearly in
+    temperature (both against log resistance). Return value is a tuple of
+    numpy arrays (Z, LOWER, UPPER).
+    """
+    steps = np.arange(subdivisions) / subdivisions
+    z_dense = np.concatenate([(z[:-1, np.newaxis] +
+                               np.diff(z)[:, np.newaxis] * steps).ravel(),
+                              [z[-1]]])
+    log_linear = 10 ** np.interp(z_dense, z, np.log10(t))
+    linear = np.interp(z_dense, z, t)
+    return (z_dense, np.minimum(log_linear, linear),
+            np.maximum(log_linear, linear))
+
+def _resolution(t):
+    """Infer the resolution of the temperatures of a breakpoint table from the
+    number of decimals they are given to."""
+    for decimals in range(0, 7):
+        scaled = t * 10 ** decimals
+        if np.allclose(scaled, np.round(scaled), rtol=0, atol=1E-6):
+            return 10.0 ** -decimals
+    return 0.0
+
+def fit_band(z, t, error_target=ERROR_TARGET, max_order=MAX_ORDER,
+             resolution=0.0):
+    """Fit a Chebychev series of log temperature, of the lowest sufficient
+    order, to a band.
+
+    Series of log10(T) are fitted to the breakpoints by least squares, i.e.,
+    in relative error. Between breakpoints, the curve is only known to lie
+    between the interpolations of the breakpoints linear in temperature and
+    linear in log temperature, so the error of a fit is the largest distance,
+    on a dense grid, from the fit to the farther of the two (relative to the
+    lower one). A two-breakpoint band thus has the full interpolation
+    uncertainty as its error, not zero. A fit is sufficient if the distance is
+    nowhere larger than error_target (relative) plus half the resolution of the
+    breakpoints (absolute). Orders are tried in increasing order from 1 up to
+    max_order, but no higher than half the number of breakpoint intervals (at
+    least 1), and the first sufficient fit is returned.
+
+    Return value is a tuple (COEFFICIENTS, ERROR, SUFFICIENT) of the first
+    sufficient fit, or of the fit with the smallest error if no order is
+    sufficient.
+
+    Arguments:
+    z: numpy array of log10 resistances, in ascending order
+    t: numpy array of temperatures
+    error_target: maximum relative temperature error; defaults to ERROR_TARGET
+    max_order: maximum order of the series; defaults to MAX_ORDER
+    resolution: resolution (in K) of the breakpoint temperatures; defaults to
+                0.0
+    """
+    x = _normalize(z, z[0], z[-1])
+    z_dense, lower, upper = _dense_reference(z, t)
+    x_dense = _normalize(z_dense, z[0], z[-1])
+    allowance = error_target * lower + resolution / 2
+    # the full Vandermonde matrices are computed once, fits of lower orders use
+    # their leading columns
+    highest = min(max_order, max(1, (len(z) - 1) // 2))
+    vandermonde = chebyshev.chebvander(x, highest)
+    vandermonde_dense = chebyshev.chebvander(x_dense, highest)
+    log_t = np.log10(t)
+    best = (None, np.inf, False)
+    # r2t._chebychev_series takes at least two coefficients
+    for order in range(1, highest + 1):
+        coefficients = np.linalg.lstsq(vandermonde[:, :order + 1], log_t,
+                                       rcond=None)[0]
+        fitted = 10 ** vandermonde_dense[:, :order + 1].dot(coefficients)
+        distance = np.maximum(fitted - lower, upper - fitted)
+        error = np.max(distance / lower)
+        if np.all(distance <= allowance):
+            return coefficients, error, True
+        if error < best[1]:
+            best = (coefficients, error, False)
+    return best
+
+def _sufficient_end(z, t, start, error_target, max_order, resolution):
+    """Return the end of the band starting at start that covers the most
+    breakpoint intervals per coefficient with a sufficient fit, along with
+    that fit, or None if no band of more than one interval is sufficient."""
+    best = None
+    for end in range(start + 2, len(z)):
+        coefficients, error, sufficient = fit_band(
+            z[start:end + 1], t[start:end + 1], error_target, max_order,
+            resolution)
+        if not sufficient:
+            continue
+        score = (end - start) / len(coefficients)
+        if best is None or score >= best[0]:
+            best = (score, end, coefficients, error)
+    return best and best[1:]
+
+def fit_bands(z, t, error_target=ERROR_TARGET, max_order=MAX_ORDER,
+              resolution=None):
+    """Choose band boundaries and fit each band.
+
+    Starting from the lowest resistance, each band is chosen among the
+    candidate ends with a sufficient fit (see fit_band) so as to cover the most
+    breakpoint intervals per coefficient, which favors more bands of lower
+    order over fewer bands of high order. Where no band of more than one
+    interval has a sufficient fit, the band extends up to the next breakpoint
+    from which one has (or to the end of the table), and gets the fit with the
+    smallest error, which does not meet the error target. Adjacent bands share
+    their boundary breakpoint.
+
+    Return value is a list of tuples (ZL, ZU, COEFFICIENTS, ERROR, SUFFICIENT),
+    in ascending order of ZL, ERROR and SUFFICIENT being as returned by
+    fit_band.
+
+    Arguments:
+    z, t: breakpoints as returned by read_curve
+    error_target: maximum relative temperature error; defaults to ERROR_TARGET
+    max_order: maximum order of each series; defaults to MAX_ORDER
+    resolution: resolution (in K) of the breakpoint temperatures; defaults to
+                None, i.e., inferred from the number of decimals of t
+    """
+    if resolution is None:
+        resolution = _resolution(t)
+    bands = []
+    start = 0
+    found = _sufficient_end(z, t, start, error_target, max_order, resolution)
+    while start < len(z) - 1:
+        if found is not None:
+            end, coefficients, error = found
+            bands.append((z[start], z[end], coefficients, error, True))
+            start = end
+            found = _sufficient_end(z, t, start, error_target, max_order,
+                                    resolution)
+            continue
+        end = start + 1
+        while end < len(z) - 1:
+            found = _sufficient_end(z, t, end, error_target, max_order,
+                                    resolution)
+            if found is not None:
+                break
+            end += 1
+        coefficients, error, sufficient = fit_band(
+            z[start:end + 1], t[start:end + 1], error_target, max_order,
+            resolution)
+        bands.append((z[start], z[end], coefficients, error, sufficient))
+        start = end
+    return bands
+
+def fit_scaling_factor(z, t, reference_points):
+    """Fit the resistance scaling factor to reference points.
+
+    The standard resistance at each reference temperature is interpolated from
+    the breakpoints (linearly in log resistance and log temperature). The
+    scaling factor is the least-squares fit, in log resistance, of the ratio of
+    standard to measured resistances.
+
+    Arguments:
+    z, t: breakpoints as returned by read_curve
+    reference_points: list of tuples (RESISTANCE, TEMPERATURE) of our
+                      thermometer
+    """
+    resistances, temperatures = np.array(reference_points, dtype=float).T
+    log_t = np.log10(t)
+    # temperature decreases with z, np.interp requires ascending abscissae
+    z_std = np.interp(np.log10(temperatures), log_t[::-1], z[::-1])
+    return 10 ** np.mean(z_std - np.log10(resistances))
+
+def calibration(bands, source=None, scaling_factor=None):
+    """Assemble a calibration for r2t.load_calibration.
+
+    Arguments:
+    bands: list of bands as returned by fit_bands
+    source: description of the source of the calibration; defaults to None
+    scaling_factor: resistance scaling factor for v2t; defaults to None, i.e.,
+                    keep v2t.SCALING_FACTOR
+    """
+    return {
+        'source': source,
+        'min_resistance': 10 ** bands[0][0],
+        'max_resistance': 10 ** bands[-1][1],
+        'scaling_factor': scaling_factor,
+        'bands': [{'lower_limit': 10 ** zl,
+                   'zl': zl,
+                   'zu': zu,
+                   'coefficients': list(coefficients),
+                   'log_temperature': True,
+                   'max_relative_error': error,
+                   'meets_error_target': bool(sufficient)}
+                  for zl, zu, coefficients, error, sufficient
+                  in reversed(bands)],
+    }
+
+def _reference_point(string):
+    """Parse a reference point 'RESISTANCE,TEMPERATURE' for argparse."""
+    try:
+        resistance, temperature = string.split(',')
+        return float(resistance), float(temperature)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid reference point '%s'" % string)
+
+def main():
+    """CLI interface."""
+    description = 'Refit thermometer calibration from curve data.'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('curve', help='Lake Shore curve file (log ohms/kelvin)')
+    parser.add_argument('file', nargs='?',
+                        help='output calibration file; if not given, write to '
+                        'stdout')
+    parser.add_argument('-p', '--reference-point', type=_reference_point,
+                        action='append', dest='reference_points',
+                        metavar='RESISTANCE,TEMPERATURE',
+                        help='resistance (in ohms) of our thermometer at a '
+                        'known temperature (in K); may be repeated')
+    parser.add_argument('-e', '--error-target', type=float,
+                        default=ERROR_TARGET,
+                        help='maximum relative temperature error; defaults to '
+                        '%(default)s')
+    parser.add_argument('-n', '--max-order', type=int, default=MAX_ORDER,
+                        help='maximum order of each Chebychev series; defaults '
+                        'to %(default)s')
+    args = parser.parse_args()
+
+    try:
+        z, t = read_curve(args.curve)
+    except (IOError, OSError) as err:
+        sys.stderr.write(type(err).__name__ + ": " + str(err) + "\n")
+        sys.stderr.write("error: invalid curve file\n")
+        return
+    bands = fit_bands(z, t, args.error_target, args.max_order)
+    for zl, zu, coefficients, error, sufficient in bands:
+        sys.stderr.write("%8.1f - %8.1f ohms: order %2d, max error %.2e%s\n" %
+                         (10 ** zl, 10 ** zu, len(coefficients) - 1, error,
+                          "" if sufficient else " (above target)"))
+    missed = [band for band in bands if not band[4]]
+    if missed:
+        sys.stderr.write("warning: %d of %d bands do not meet the error target "
+                         "%.1e, up to %.2e between breakpoints\n" %
+                         (len(missed), len(bands), args.error_target,
+                          max(band[3] for band in missed)))
+    scaling_factor = None
+    if args.reference_points:
+        scaling_factor = fit_scaling_factor(z, t, args.reference_points)
+        sys.stderr.write("scaling factor: %.6f\n" % scaling_factor)
+    result = calibration(bands, args.curve, scaling_factor)
+
+    if args.file is None:
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        try:
+            with open(args.file, 'w') as output:
+                json.dump(result, output, indent=2)
+                output.write("\n")
+        except (IOError, OSError) as err:
+            sys.stderr.write(type(err).__name__ + ": " + str(err) + "\n")
+            sys.stderr.write("error: invalid output file\n")
+
+if __name__ == "__main__":
+    main()
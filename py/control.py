@@ -8,6 +8,7 @@ ps_initialized: return an initialized instance of gpib.PowerSupply
 ps_ramp_to: ramp the output current of the power supply to a specified value
 ps_monitor_current: monitor and save power supply output current
 li_monitor: monitor and save lock-in amplifier data points
+ps_stop_on_quench: return an anomaly handler stopping the power supply ramp
 """
 
 from __future__ import division
@@ -17,7 +18,10 @@ import argparse
 import sys
 import time
 
+import anomaly
 import gpib
+import magnet
+import stream
 import v2t
 
 def ps_initialize(power_supply):
@@ -29,16 +33,11 @@ def ps_initialize(power_supply):
     """
     power_supply.set_limits(20.5, 5.0, 0.4)
     power_supply.set_compliance_voltage(5.0)
-    power_supply.set_magnetic_field_constant(0.07377)
+    power_supply.set_magnetic_field_constant(
+        magnet.MAGNETIC_FIELD_CONSTANT)
     power_supply.enable_quench_detection()
     power_supply.enable_ramp_segments()
-    ramp_segments = [
-        (6.8, 0.3), # rated current
-        (13.6, 0.2),
-        (20.4, 0.1),
-        (60.0, 0.0001)
-    ]
-    power_supply.set_ramp_segments_params(ramp_segments)
+    power_supply.set_ramp_segments_params(magnet.RAMP_SEGMENTS)
 
 def ps_initialized():
     """Return an initialized instance of gpib.PowerSupply.
@@ -70,7 +69,8 @@ def ps_ramp_to(power_supply, current):
     assert 0 <= current < 20.5
     power_supply.set_target_current(current)
 
-def ps_monitor_current(power_supply, output=sys.stdout, print_to_console=True):
+def ps_monitor_current(power_supply, output=sys.stdout, print_to_console=True,
+                       detector=None, on_anomaly=None, publisher=None):
     """Monitor and save power supply output current until keyboard interrupt.
 
     Data points (timestamp and current) are saved to power_supply.data, and
@@ -79,68 +79,172 @@ def ps_monitor_current(power_supply, output=sys.stdout, print_to_console=True):
     True.
 
     Adjacent recordings will be seperated by at least
-    power_supply.sampling_interval (0.125 seconds by default). See
-    gpib.PowerSupply.record_current for details.
+    power_supply.sampling_interval (0.1 seconds by default), also after a
+    retried request. See gpib.PowerSupply.record_current for details.
+
+    If an anomaly detector is given, the output voltage is also recorded for
+    every data point (see gpib.PowerSupply.record_current; this is a second
+    query per data point), and current and voltage are checked. On any
+    anomaly, it is reported to stderr, on_anomaly is called, and data points
+    recorded so far are saved to the output file right away.
+
+    If a publisher is given, every data point is also published to live
+    subscribers as soon as it is recorded.
 
     Arguments:
     power_supply: gpib.PowerSupply instance
     output: file object for writing output; defaults to sys.stdout
     print_to_console: if True, print to stderr in addtion to saving; defaults to
                       True
+    detector: anomaly.AnomalyDetector instance; defaults to None, i.e., no
+              anomaly detection
+    on_anomaly: function called with each anomaly.Anomaly detected; defaults
+                to None
+    publisher: stream.Publisher instance; defaults to None, i.e., no live
+               streaming
     """
     sys.stderr.write("beginning data collection\n")
+    saved = 0
     while True:
         try:
-            current = power_supply.record_current(wait=True,
-                                                  raise_exception=True)
+            current = power_supply.record_current(
+                wait=True, raise_exception=True,
+                record_voltage=detector is not None)
+            if publisher is not None:
+                publisher.publish(power_supply.last_recording, current)
             if print_to_console:
                 sys.stderr.write("current: %7.4f A\r" % current)
                 sys.stderr.flush()
+            if detector is not None:
+                timestamp = power_supply.last_recording
+                anomalies = detector.check_current(timestamp, current)
+                # a failed voltage read only skips the voltage check
+                voltage = power_supply.data[-1].get('voltage')
+                if voltage is not None:
+                    anomalies += detector.check_voltage(timestamp, voltage)
+                if anomalies:
+                    _handle_anomalies(anomalies, on_anomaly)
+                    saved = _save_ps_data(power_supply.data, output, saved)
         except RuntimeError:
             sys.stderr.write("\nlost contact with the instrument\n")
             break
-        except KeyboardInterrupt:
-            sys.stderr.write("\ninterrupted\n")
+        except KeyboardInterrupt as err:
+            # e.g., replay.EndOfReplay carries its own message
+            sys.stderr.write("\n%s\n" % (str(err) or "interrupted"))
             break
-    for data_point in power_supply.data:
-        output.write("%.4f,%.4f\n" %
-                     (data_point['timestamp'], data_point['current']))
+    _save_ps_data(power_supply.data, output, saved)
+
+def _save_data(data, key, value_format, output, start=0):
+    """Write data points from index start; return the new end.
+
+    Each line holds the timestamp and the value, followed, if known, by the
+    request-sent and reply-received times and the number of retries (see
+    gpib._GPIBInstrument.last_timing), and, if recorded, the power supply
+    output voltage ('nan' if its read failed).
+    """
+    line_format = "%.4f," + value_format
+    for data_point in data[start:]:
+        line = line_format % (data_point['timestamp'], data_point[key])
+        if 'sent' in data_point:
+            line += ",%.4f,%.4f,%d" % (data_point['sent'],
+                                       data_point['received'],
+                                       data_point['retries'])
+            if 'voltage' in data_point:
+                voltage = data_point['voltage']
+                line += ",%.4f" % (voltage if voltage is not None
+                                   else float('nan'))
+        output.write(line + "\n")
+    output.flush()
+    return len(data)
+
+def _save_ps_data(data, output, start=0):
+    """Write power supply data points from index start; return the new end."""
+    return _save_data(data, 'current', "%.4f", output, start)
+
+def _save_li_data(data, output, start=0):
+    """Write lock-in data points from index start; return the new end."""
+    return _save_data(data, 'value', "%.4E", output, start)
+
+def _handle_anomalies(anomalies, on_anomaly=None):
+    """Report anomalies to stderr and pass them to on_anomaly."""
+    for event in anomalies:
+        sys.stderr.write("\nanomaly detected: %s\n" % event.message)
+        if on_anomaly is not None:
+            on_anomaly(event)
+
+def ps_stop_on_quench(power_supply):
+    """Return an anomaly handler stopping the power supply ramp.
 
-def li_monitor(lock_in, output=sys.stdout, print_to_console=True):
+    The handler calls power_supply.stop() on current steps, the signature of a
+    quench, and ignores other anomalies. Voltage spikes alone are not acted on:
+    the output voltage also jumps by L dI/dt whenever a normal ramp starts or
+    enters a new ramp segment.
+
+    Arguments:
+    power_supply: gpib.PowerSupply instance
+    """
+    def handler(event):
+        if event.kind == 'current_step':
+            sys.stderr.write("stopping current ramp\n")
+            power_supply.stop()
+    return handler
+
+def li_monitor(lock_in, output=sys.stdout, print_to_console=True,
+               detector=None, on_anomaly=None, publisher=None):
     """Monitor and save lock-in amplifier data points until keyboard interrupt.
 
+    If an anomaly detector is given, every data point is checked for stuck
+    readings and temperature spikes. If a publisher is given, every data point
+    is published to live subscribers. See ps_monitor_current.
+
     Arguments:
     lock_in: gpib.LockIn instance; must be initialized with the
              gpib.LockIn.initialize method
     output: file object for writing output; defaults to sys.stdout
     print_to_console: if True, print to stderr in addtion to saving; defaults to
                       True
+    detector: anomaly.AnomalyDetector instance; defaults to None, i.e., no
+              anomaly detection
+    on_anomaly: function called with each anomaly.Anomaly detected; defaults
+                to None
+    publisher: stream.Publisher instance; defaults to None
     """
     sys.stderr.write("beginning data collection\n")
+    saved = 0
     while True:
         try:
             voltage = lock_in.record_value(wait=True, raise_exception=True)
+            if publisher is not None:
+                publisher.publish(lock_in.last_recording, voltage)
             resistance = v2t.v2r(voltage)
+            try:
+                temperature = v2t.v2t(voltage)
+            except AssertionError:
+                temperature = None
             if print_to_console:
                 voltage_str = "%6.3f uV" % (voltage * 1E6)
                 resistance_str = u"%6.1f \u03A9" % resistance
-                try:
-                    temperature = v2t.v2t(voltage)
+                if temperature is not None:
                     temperature_str = "%6.3f K" % temperature
-                except AssertionError:
+                else:
                     temperature_str = "out of range"
                 status = "voltage: %-16sresistance: %-16stemperature: %-16s\r" \
                          % (voltage_str, resistance_str, temperature_str)
                 sys.stderr.write(status)
+            if detector is not None:
+                anomalies = detector.check_lock_in(lock_in.last_recording,
+                                                   voltage, temperature)
+                if anomalies:
+                    _handle_anomalies(anomalies, on_anomaly)
+                    saved = _save_li_data(lock_in.data, output, saved)
         except RuntimeError:
             sys.stderr.write("\nlost contact with the instrument\n")
             break
-        except KeyboardInterrupt:
-            sys.stderr.write("\ninterrupted\n")
+        except KeyboardInterrupt as err:
+            # e.g., replay.EndOfReplay carries its own message
+            sys.stderr.write("\n%s\n" % (str(err) or "interrupted"))
             break
-    for data_point in lock_in.data:
-        output.write("%.4f,%.4E\n" %
-                     (data_point['timestamp'], data_point['value']))
+    _save_li_data(lock_in.data, output, saved)
 
 def main():
     """CLI interface."""
@@ -150,32 +254,63 @@ def main():
                         help="action to perform")
     parser.add_argument('file', nargs='?',
                         help="output file; if not given, write to stdout")
+    parser.add_argument('-a', '--detect-anomalies', action='store_true',
+                        help="detect quenches and other anomalies while "
+                        "monitoring")
+    parser.add_argument('-s', '--stop-on-quench', action='store_true',
+                        help="stop the current ramp when a quench is detected "
+                        "(implies --detect-anomalies)")
+    parser.add_argument('-p', '--publish', action='store_true',
+                        help="publish data points to live subscribers (see "
+                        "stream.py)")
     args = parser.parse_args()
+    detector = None
+    if args.detect_anomalies or args.stop_on_quench:
+        detector = anomaly.AnomalyDetector(magnet.RAMP_SEGMENTS)
+    publisher = None
+    if args.publish:
+        channel = args.action[len('monitor-'):]
+        try:
+            publisher = stream.Publisher(channel)
+        except (IOError, OSError) as err:
+            sys.stderr.write(type(err).__name__ + ": " + str(err) + "\n")
+            sys.stderr.write("error: failed to start publisher\n")
+            return
     if args.action == 'monitor-power-supply':
         power_supply = gpib.PowerSupply()
+        on_anomaly = None
+        if args.stop_on_quench:
+            on_anomaly = ps_stop_on_quench(power_supply)
         if args.file is None:
-            ps_monitor_current(power_supply)
+            ps_monitor_current(power_supply, detector=detector,
+                               on_anomaly=on_anomaly, publisher=publisher)
         else:
             try:
                 with open(args.file, 'w') as output:
-                    ps_monitor_current(power_supply, output)
+                    ps_monitor_current(power_supply, output,
+                                       detector=detector,
+                                       on_anomaly=on_anomaly,
+                                       publisher=publisher)
             except (IOError, OSError) as err:
                 sys.stderr.write(type(err).__name__ + ": " + str(err) + "\n")
                 sys.stderr.write("error: invalid output file\n")
     elif args.action == 'monitor-lock-in':
         lock_in = gpib.LockIn()
         if args.file is None:
-            li_monitor(lock_in)
+            li_monitor(lock_in, detector=detector, publisher=publisher)
         else:
             try:
                 with open(args.file, 'w') as output:
-                    li_monitor(lock_in, output)
+                    li_monitor(lock_in, output, detector=detector,
+                               publisher=publisher)
             except (IOError, OSError) as err:
                 sys.stderr.write(type(err).__name__ + ": " + str(err) + "\n")
                 sys.stderr.write("error: invalid output file\n")
     else:
         # placeholder for other possible actions
         pass
+    if publisher is not None:
+        publisher.close()
 
 if __name__ == "__main__":
     main()
@@ -5,25 +5,132 @@
 from __future__ import division
 from __future__ import print_function
 
+import sys
 import time
 import warnings
 
-import visa
+try:
+    import visa
+except ImportError:
+    # this module can still be imported (e.g., by control.py for replay.py)
+    # without pyvisa; instruments cannot be opened though
+    visa = None
 
 _VISA_PATH = '/cygdrive/c/Windows/System32/visa32.dll'
-_instrument_manager = visa.ResourceManager(_VISA_PATH)
+_instrument_manager = None
+
+# clock_gettime clock ids of CLOCK_MONOTONIC, by sys.platform prefix
+_CLOCK_MONOTONIC = {'linux': 1, 'cygwin': 4, 'darwin': 6}
+
+def _monotonic_clock():
+    """Return a monotonic clock function (in seconds), or None.
+
+    Python 2 has no time.monotonic. There, time.clock is used on Windows, where
+    it reads the performance counter, and clock_gettime(CLOCK_MONOTONIC) is
+    called through ctypes on Linux, Cygwin and OS X.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    if sys.platform == 'win32':
+        return time.clock
+    clock_id = [clock_id for prefix, clock_id in _CLOCK_MONOTONIC.items()
+                if sys.platform.startswith(prefix)]
+    if not clock_id:
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+
+        class Timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        # clock_gettime is in librt with older glibc
+        for library in (None, ctypes.util.find_library('rt')):
+            try:
+                clock_gettime = ctypes.CDLL(library).clock_gettime
+                break
+            except (OSError, AttributeError):
+                continue
+        else:
+            return None
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+
+        def monotonic():
+            timespec = Timespec()
+            if clock_gettime(clock_id[0], ctypes.byref(timespec)) != 0:
+                raise OSError("clock_gettime failed")
+            return timespec.tv_sec + timespec.tv_nsec * 1E-9
+        monotonic()
+        return monotonic
+    except (ImportError, OSError):
+        return None
+
+# clock for timing requests; falls back to wall clock (time.time) if no
+# monotonic clock is available
+_monotonic = _monotonic_clock() or time.time
+
+def _get_instrument_manager():
+    """Return the pyvisa ResourceManager, creating it on first use."""
+    global _instrument_manager
+    if _instrument_manager is None:
+        if visa is None:
+            raise ImportError("pyvisa is required to access GPIB instruments")
+        _instrument_manager = visa.ResourceManager(_VISA_PATH)
+    return _instrument_manager
 
 class _GPIBInstrument(object):
     """Generic GPIB instrument interface.
 
+    Requests are timed with a monotonic clock, anchored to wall clock once
+    when the instrument is created, so that timings are immune to wall clock
+    adjustments during a run but can still be compared across instruments. On
+    python 2, the monotonic clock is read through time.clock (Windows) or
+    clock_gettime (Linux, Cygwin, OS X); on any other platform, timings fall
+    back to the wall clock and are not immune to its adjustments.
+
     Attributes:
     instrument: pyvisa.resources.GPIBInstrument object returned by
                 pyvisa.ResourceManager.get_resource
+    clock_anchor: tuple (WALL_CLOCK, MONOTONIC) of time.time() and the
+                  monotonic clock read at the same instant (both the given
+                  clock if any)
+    last_timing: timing of the last successful ask, a dict with keys 'sent'
+                 and 'received' (request-sent and reply-received times of the
+                 successful try; see wall_clock) and 'retries' (number of
+                 failed tries before it); None before the first ask
     """
 
-    def __init__(self, instrument_id):
-        """Get instrument by instrument_id from pyvisa ResourceManage."""
-        self.instrument = _instrument_manager.get_instrument(instrument_id)
+    def __init__(self, instrument_id, instrument=None, clock=None):
+        """Get instrument by instrument_id from pyvisa ResourceManage.
+
+        Arguments:
+        instrument_id: pyvisa resource name
+        instrument: object with the ask and write methods of a pyvisa
+                    instrument, used instead of opening instrument_id (e.g.,
+                    replay.LogInstrument); defaults to None
+        clock: function returning the time in seconds since the epoch, used
+               instead of the system clocks (e.g., the log time in replay.py);
+               defaults to None
+        """
+        if instrument is None:
+            instrument = _get_instrument_manager().get_instrument(
+                instrument_id)
+        self.instrument = instrument
+        if clock is None:
+            self._clock = _monotonic
+            self.clock_anchor = (time.time(), _monotonic())
+        else:
+            self._clock = clock
+            now = clock()
+            self.clock_anchor = (now, now)
+        self.last_timing = None
+
+    def wall_clock(self, monotonic_time=None):
+        """Convert a monotonic clock reading to wall clock (seconds since the
+        epoch) using clock_anchor; defaults to the current time."""
+        if monotonic_time is None:
+            monotonic_time = self._clock()
+        return self.clock_anchor[0] + (monotonic_time - self.clock_anchor[1])
 
     def ask(self, command, convert=None,
             tries=3, wait=0.5, exponential_backoff=True):
@@ -38,12 +145,19 @@ class _GPIBInstrument(object):
               doubled each time is exponential_backoff is True
         exponential_backoff: whether or not to double wait time between
                              consecutive tries; defaults to True
+
+        The timing of the successful try is saved in last_timing.
         """
-        for _ in range(0, tries):
+        for retries in range(0, tries):
             try:
+                sent = self._clock()
                 result = self.instrument.ask(command)
+                received = self._clock()
                 if convert is not None:
                     result = convert(result)
+                self.last_timing = {'sent': self.wall_clock(sent),
+                                    'received': self.wall_clock(received),
+                                    'retries': retries}
                 return result
             except Exception as err:
                 warnings.warn("command '%s' failed with exception:\n%s" %\
@@ -76,52 +190,79 @@ class _GPIBInstrument(object):
         raise RuntimeError("write '%s' failed after %d tries" %\
                            (command, tries))
 
+def _timed_data_point(timing):
+    """Return a data point dict with timing keys and the midpoint timestamp."""
+    data_point = dict(timing)
+    data_point['timestamp'] = (timing['sent'] + timing['received']) / 2
+    return data_point
+
 class PowerSupply(_GPIBInstrument):
     """Remote interface to LakeShore Model 625 SC Magnet Power Supply.
 
     Attributes:
     data: a list of recorded data points, each data point being a dict with
-          'timestamp' and data types (e.g., 'current') as keys
-    last_recording: timestamp of the last data point recorded (time.time())
+          'timestamp' and data types (e.g., 'current') as keys, along with the
+          timing keys of _GPIBInstrument.last_timing; 'timestamp' is the
+          midpoint between request sent and reply received
+    last_recording: timestamp of the last data point recorded
     sampling_interval: minimum sampling interval used for data recording
     """
 
     _INSTRUMENT_ID = 'GPIB0::20::INSTR'
 
-    def __init__(self, sampling_interval=0.1):
+    def __init__(self, sampling_interval=0.1, instrument=None, clock=None):
         """
         PowerSupply class constructor.
 
         Arguments:
         sampling_interval: minimum sampling interval (in seconds) used for data
                            recording; defaults to 0.1, i.e., 10 Hz
+        instrument, clock: see _GPIBInstrument; default to None
         """
-        super(PowerSupply, self).__init__(self._INSTRUMENT_ID)
+        super(PowerSupply, self).__init__(self._INSTRUMENT_ID, instrument,
+                                          clock)
         self.data = []
         self.last_recording = 0
         self.sampling_interval = sampling_interval
 
-    def record_current(self, wait=False, raise_exception=False):
+    def record_current(self, wait=False, raise_exception=False,
+                       record_voltage=False):
         """Record current in self.data.
 
         Return value is the measured current.
 
         Arguments:
-        wait: boolean; if wait is True, data point will be recorded at least
-              one sample interval apart from the time of last recording (see
-              the sampling_interval and last_recording attributes)
+        wait: boolean; if wait is True, the data point will be requested at
+              least one sample interval after the reply to the previous
+              request (see the sampling_interval and last_timing attributes),
+              so that adjacent data points are at least one sample interval
+              apart
         raise_exception: boolean; if raise_exception is True, raise RuntimeError
                          if recording failed
+        record_voltage: boolean; if record_voltage is True, the output voltage
+                        is also read (a second query, tried only once) and
+                        saved in the data point as 'voltage', None if the read
+                        failed; defaults to False
         """
         try:
-            if wait:
-                while (time.time() - self.last_recording <
+            if wait and self.last_timing is not None:
+                # paced from the last reply, so that retries do not shorten
+                # the interval to the next data point
+                while (self.wall_clock() - self.last_timing['received'] <
                        self.sampling_interval):
                     pass
-            timestamp = time.time()
             current = self.get_current()
-            self.data.append({'timestamp': timestamp, 'current': current})
-            self.last_recording = timestamp
+            data_point = _timed_data_point(self.last_timing)
+            data_point['current'] = current
+            if record_voltage:
+                try:
+                    data_point['voltage'] = self.ask('RDGV?', convert=float,
+                                                     tries=1, wait=0)
+                except RuntimeError:
+                    warnings.warn('failed to record voltage')
+                    data_point['voltage'] = None
+            self.data.append(data_point)
+            self.last_recording = data_point['timestamp']
             return current
         except RuntimeError:
             warnings.warn('failed to record current')
@@ -296,21 +437,25 @@ class LockIn(_GPIBInstrument):
 
     Attributes:
     data: a list of recorded data points, each data point being a dict with
-          'timestamp' and 'value' as keys
-    last_recording: timestamp of the last data point recorded (time.time())
+          'timestamp' and 'value' as keys, along with the timing keys of
+          _GPIBInstrument.last_timing; 'timestamp' is the midpoint between
+          request sent and reply received
+    last_recording: timestamp of the last data point recorded
     sampling_interval: minimum sampling interval used for data recording
     """
 
     _INSTRUMENT_ID = 'GPIB0::8::INSTR'
 
-    def __init__(self, sampling_interval=0.1):
+    def __init__(self, sampling_interval=0.1, instrument=None, clock=None):
         """LockIn class constructor.
 
         Arguments:
         sampling_interval: minimum sampling interval (in seconds) used for data
                            recording; defaults to 0.1, i.e., 10 Hz
+        instrument, clock: see _GPIBInstrument; default to None
         """
-        super(LockIn, self).__init__(self._INSTRUMENT_ID)
+        super(LockIn, self).__init__(self._INSTRUMENT_ID, instrument,
+                                     clock)
         self.data = []
         self.last_recording = 0
         self.sampling_interval = sampling_interval
@@ -321,21 +466,26 @@ class LockIn(_GPIBInstrument):
         Return value is the value on Channel 1 display (returned by get_value).
 
         Arguments:
-        wait: boolean; if wait is True, data point will be recorded at least
-              one sample interval apart from the time of last recording (see
-              the sampling_interval and last_recording attributes)
+        wait: boolean; if wait is True, the data point will be requested at
+              least one sample interval after the reply to the previous
+              request (see the sampling_interval and last_timing attributes),
+              so that adjacent data points are at least one sample interval
+              apart
         raise_exception: boolean; if raise_exception is True, raise RuntimeError
                          if recording failed
         """
         try:
-            if wait:
-                while (time.time() - self.last_recording <
+            if wait and self.last_timing is not None:
+                # paced from the last reply, so that retries do not shorten
+                # the interval to the next data point
+                while (self.wall_clock() - self.last_timing['received'] <
                        self.sampling_interval):
                     pass
-            timestamp = time.time()
             value = self.get_value()
-            self.data.append({'timestamp': timestamp, 'value': value})
-            self.last_recording = timestamp
+            data_point = _timed_data_point(self.last_timing)
+            data_point['value'] = value
+            self.data.append(data_point)
+            self.last_recording = data_point['timestamp']
             return value
         except RuntimeError:
             warnings.warn('failed to record value')
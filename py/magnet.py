@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+
+"""Parameters of the superconducting magnet.
+
+Shared by the instrument controller (control.py) and the offline tools, which
+must not depend on the hardware modules.
+
+Constants:
+MAGNETIC_FIELD_CONSTANT: magnetic field constant of the magnet (in T/A)
+RAMP_SEGMENTS: ramp segments (CURRENT, RATE) of the power supply
+"""
+
+# magnetic field constant of the magnet (in T/A), set by control.ps_initialize
+MAGNETIC_FIELD_CONSTANT = 0.07377
+
+# ramp segments (CURRENT, RATE) set by control.ps_initialize, also the
+# reference for current steps in anomaly detection
+RAMP_SEGMENTS = [
+    (6.8, 0.3), # rated current
+    (13.6, 0.2),
+    (20.4, 0.1),
+    (60.0, 0.0001)
+]
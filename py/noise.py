@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+
+"""Noise spectrum and Allan deviation of lock-in logs.
+
+Lock-in logs have irregular timestamps, as the sampling interval is set by the
+polling loop and bus latency. This module reads a lock-in-*.log in chunks,
+resamples it by linear interpolation onto a uniform grid, and accumulates
+
+1. the Welch power spectral density (Hann window, 50% overlap, mean removed
+   from each segment), with the FFTs of the segments spread over a process
+   pool;
+2. the (non-overlapping) Allan deviation at averaging times of 2^k sampling
+   intervals.
+
+Both are computed incrementally, so memory use is bounded by the chunk size,
+the segment length and the longest averaging time, regardless of the length
+of the log. Gaps in the log (e.g., lost contact with the instrument) are
+bridged by the interpolation and counted. Note that linear interpolation
+attenuates white noise (by up to a third in power when the grid interval equals
+the mean sampling interval), most strongly near the Nyquist frequency.
+
+The averaging time at which the Allan deviation is minimal separates the white
+noise regime from drift; it is the optimal averaging time. A lock-in time
+constant TC (6 dB/oct) has an equivalent noise bandwidth of 1/(4 TC), the same
+as averaging over 2 TC, so the suggested time constant is the longest SR830
+time constant not exceeding half the optimal averaging time.
+
+Classes:
+Resampler: resample irregular data points onto a uniform grid
+WelchAccumulator: accumulate a Welch power spectral density
+AllanAccumulator: accumulate Allan deviations
+
+Functions:
+read_chunks: read a log file in chunks of timestamp and value arrays
+analyze: compute the noise spectrum and Allan deviation of a log
+suggest_time_constant: suggest a lock-in time constant for an averaging time
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import multiprocessing
+import sys
+
+import numpy as np
+
+# number of lines read at a time
+CHUNK_SIZE = 100000
+
+# number of samples per Welch segment
+SEGMENT_LENGTH = 4096
+
+# number of Welch segments per task sent to the process pool
+_SEGMENTS_PER_TASK = 64
+
+# SR830 time constants (in seconds), 10 us to 30 ks
+TIME_CONSTANTS = [mantissa * 10 ** exponent for exponent in range(-5, 5)
+                  for mantissa in (1, 3)]
+
+def read_chunks(logfilename, chunk_size=CHUNK_SIZE):
+    """Read a log file in chunks of timestamp and value arrays.
+
+    Only the first two columns (timestamp and value) are used. Malformed
+    lines (e.g., a last line cut off mid-write) are skipped with a note on
+    stderr, as in replay.py. Yields tuples of two numpy arrays of at most
+    chunk_size elements.
+    """
+    with open(logfilename) as logfile:
+        rows = []
+        for line_number, line in enumerate(logfile, 1):
+            if not line.strip():
+                continue
+            try:
+                timestamp, value = line.strip().split(',')[:2]
+                rows.append((float(timestamp), float(value)))
+            except ValueError:
+                sys.stderr.write("%s:%d: skipping malformed line\n" %
+                                 (logfilename, line_number))
+                continue
+            if len(rows) == chunk_size:
+                data = np.array(rows, dtype=float)
+                yield data[:, 0], data[:, 1]
+                rows = []
+        if rows:
+            data = np.array(rows, dtype=float)
+            yield data[:, 0], data[:, 1]
+
+class Resampler(object):
+    """Resample irregular data points onto a uniform grid.
+
+    The last data point of each chunk is carried over, so that the grid is
+    continuous across chunks. Data points not later than their predecessor are
+    dropped.
+
+    Attributes:
+    interval: sampling interval (in seconds) of the grid
+    max_gap: gaps between data points longer than max_gap (in seconds) are
+             counted in gaps
+    gaps: number of gaps longer than max_gap bridged
+    """
+
+    def __init__(self, interval, max_gap=None):
+        """Resampler class constructor.
+
+        Arguments:
+        interval: sampling interval (in seconds) of the grid
+        max_gap: defaults to ten sampling intervals
+        """
+        self.interval = interval
+        self.max_gap = max_gap if max_gap is not None else 10 * interval
+        self.gaps = 0
+        self._last = None
+        self._next = None
+
+    def resample(self, timestamps, values):
+        """Return the grid values covered by a chunk of data points."""
+        if self._last is not None:
+            timestamps = np.concatenate([[self._last[0]], timestamps])
+            values = np.concatenate([[self._last[1]], values])
+        # keep strictly increasing timestamps only
+        keep = np.concatenate([[True], timestamps[1:] >
+                               np.maximum.accumulate(timestamps)[:-1]])
+        timestamps = timestamps[keep]
+        values = values[keep]
+        if len(timestamps) == 0:
+            return np.empty(0)
+        if self._next is None:
+            self._next = timestamps[0]
+        self.gaps += int(np.sum(np.diff(timestamps) > self.max_gap))
+        self._last = (timestamps[-1], values[-1])
+
+        count = int(np.floor((timestamps[-1] - self._next) / self.interval)) + 1
+        if count <= 0:
+            return np.empty(0)
+        grid = self._next + self.interval * np.arange(count)
+        self._next = grid[-1] + self.interval
+        return np.interp(grid, timestamps, values)
+
+def _periodograms(task):
+    """Sum of the squared FFT magnitudes of windowed, mean-removed segments."""
+    segments, window = task
+    segments = segments - segments.mean(axis=1)[:, np.newaxis]
+    spectra = np.fft.rfft(segments * window, axis=1)
+    return np.sum(spectra.real ** 2 + spectra.imag ** 2, axis=0)
+
+class WelchAccumulator(object):
+    """Accumulate a Welch power spectral density.
+
+    Segments overlap by half their length. Full segments are sent to the
+    process pool in batches, with a bounded number of batches in flight.
+
+    Attributes:
+    interval: sampling interval (in seconds)
+    segment_length: number of samples per segment
+    segments: number of segments accumulated
+    """
+
+    def __init__(self, interval, segment_length=SEGMENT_LENGTH, pool=None,
+                 max_pending=None):
+        """WelchAccumulator class constructor.
+
+        Arguments:
+        interval: sampling interval (in seconds)
+        segment_length: defaults to SEGMENT_LENGTH
+        pool: multiprocessing.Pool for the FFTs; defaults to None, i.e.,
+              compute in this process
+        max_pending: maximum number of batches in flight; defaults to twice
+                     the number of CPUs
+        """
+        self.interval = interval
+        self.segment_length = segment_length
+        self.segments = 0
+        self._window = np.hanning(segment_length)
+        self._buffer = np.empty(0)
+        self._batch = []
+        self._pool = pool
+        self._pending = collections.deque()
+        self._max_pending = (max_pending if max_pending is not None
+                             else 2 * multiprocessing.cpu_count())
+        self._sum = np.zeros(segment_length // 2 + 1)
+
+    def _dispatch(self):
+        """Send the current batch of segments off for FFT."""
+        if not self._batch:
+            return
+        task = (np.array(self._batch), self._window)
+        self.segments += len(self._batch)
+        self._batch = []
+        if self._pool is None:
+            self._sum += _periodograms(task)
+            return
+        self._pending.append(self._pool.apply_async(_periodograms, (task,)))
+        while len(self._pending) > self._max_pending:
+            self._sum += self._pending.popleft().get()
+
+    def add(self, samples):
+        """Add uniformly sampled values."""
+        self._buffer = np.concatenate([self._buffer, samples])
+        step = self.segment_length // 2
+        start = 0
+        while start + self.segment_length <= len(self._buffer):
+            self._batch.append(self._buffer[start:start + self.segment_length])
+            if len(self._batch) == _SEGMENTS_PER_TASK:
+                self._dispatch()
+            start += step
+        self._buffer = self._buffer[start:].copy()
+
+    def psd(self):
+        """Return a tuple (FREQUENCIES, PSD) of numpy arrays.
+
+        The PSD is one-sided, in units of value^2/Hz. Both arrays are empty if
+        there is not a single full segment.
+        """
+        self._dispatch()
+        while self._pending:
+            self._sum += self._pending.popleft().get()
+        if self.segments == 0:
+            return np.empty(0), np.empty(0)
+        frequencies = np.fft.rfftfreq(self.segment_length, self.interval)
+        scale = self.interval / np.sum(self._window ** 2)
+        psd = self._sum / self.segments * scale
+        # one-sided: double all but DC and (for even lengths) Nyquist
+        if self.segment_length % 2 == 0:
+            psd[1:-1] *= 2
+        else:
+            psd[1:] *= 2
+        return frequencies, psd
+
+class AllanAccumulator(object):
+    """Accumulate Allan deviations.
+
+    For each averaging factor m, samples are averaged in consecutive blocks of
+    m, and squared differences of consecutive block averages are summed.
+    Samples not filling a block are carried over to the next chunk.
+
+    Attributes:
+    interval: sampling interval (in seconds)
+    factors: list of averaging factors
+    """
+
+    def __init__(self, interval, max_factor=2 ** 16):
+        """AllanAccumulator class constructor.
+
+        Arguments:
+        interval: sampling interval (in seconds)
+        max_factor: largest averaging factor; factors are the powers of two up
+                    to max_factor; defaults to 2 ** 16
+        """
+        self.interval = interval
+        self.factors = [2 ** k for k in range(int(np.log2(max_factor)) + 1)]
+        self._leftover = dict((m, np.empty(0)) for m in self.factors)
+        self._last_mean = dict((m, None) for m in self.factors)
+        self._sum_sq = dict((m, 0.0) for m in self.factors)
+        self._count = dict((m, 0) for m in self.factors)
+
+    def add(self, samples):
+        """Add uniformly sampled values."""
+        for m in self.factors:
+            data = np.concatenate([self._leftover[m], samples])
+            blocks = len(data) // m
+            self._leftover[m] = data[blocks * m:]
+            if blocks == 0:
+                continue
+            means = data[:blocks * m].reshape(blocks, m).mean(axis=1)
+            if self._last_mean[m] is not None:
+                means = np.concatenate([[self._last_mean[m]], means])
+            self._last_mean[m] = means[-1]
+            differences = np.diff(means)
+            self._sum_sq[m] += np.sum(differences ** 2)
+            self._count[m] += len(differences)
+
+    def deviation(self, min_differences=10):
+        """Return a tuple (TAUS, DEVIATIONS) of numpy arrays.
+
+        The relative uncertainty of an Allan deviation estimated from N
+        differences is about 1/sqrt(N), so only averaging times with at least
+        min_differences differences (defaults to 10) are included.
+        """
+        factors = [m for m in self.factors
+                   if self._count[m] >= max(min_differences, 1)]
+        taus = np.array([m * self.interval for m in factors])
+        deviations = np.array([np.sqrt(self._sum_sq[m] / (2 * self._count[m]))
+                               for m in factors])
+        return taus, deviations
+
+def suggest_time_constant(tau):
+    """Return the longest SR830 time constant not exceeding tau / 2."""
+    candidates = [tc for tc in TIME_CONSTANTS if tc <= tau / 2]
+    return candidates[-1] if candidates else TIME_CONSTANTS[0]
+
+def analyze(logfilename, interval=None, segment_length=SEGMENT_LENGTH,
+            processes=None, chunk_size=CHUNK_SIZE):
+    """Compute the noise spectrum and Allan deviation of a log.
+
+    Return value is a dict with keys 'interval', 'samples' (number of grid
+    samples), 'gaps', 'frequencies' and 'psd' (see WelchAccumulator.psd), and
+    'taus' and 'deviations' (see AllanAccumulator.deviation).
+
+    Arguments:
+    logfilename: lock-in log file
+    interval: sampling interval (in seconds) of the uniform grid; defaults to
+              the median interval of the first chunk
+    segment_length: number of samples per Welch segment; defaults to
+                    SEGMENT_LENGTH
+    processes: number of worker processes for the FFTs; defaults to the number
+               of CPUs
+    chunk_size: number of lines read at a time; defaults to CHUNK_SIZE
+    """
+    pool = multiprocessing.Pool(processes)
+    try:
+        resampler = welch = allan = None
+        samples = 0
+        for timestamps, values in read_chunks(logfilename, chunk_size):
+            if resampler is None:
+                if interval is None:
+                    assert len(timestamps) > 1, \
+                        "too few data points in %s" % logfilename
+                    interval = float(np.median(np.diff(timestamps)))
+                    assert interval > 0, "cannot infer sampling interval"
+                resampler = Resampler(interval)
+                welch = WelchAccumulator(interval, segment_length, pool,
+                                         2 * (processes or
+                                              multiprocessing.cpu_count()))
+                allan = AllanAccumulator(interval)
+            uniform = resampler.resample(timestamps, values)
+            samples += len(uniform)
+            welch.add(uniform)
+            allan.add(uniform)
+        assert resampler is not None, "empty log %s" % logfilename
+        frequencies, psd = welch.psd()
+        taus, deviations = allan.deviation()
+    finally:
+        pool.close()
+        pool.join()
+    return {'interval': interval, 'samples': samples, 'gaps': resampler.gaps,
+            'frequencies': frequencies, 'psd': psd,
+            'taus': taus, 'deviations': deviations}
+
+def main():
+    """CLI interface."""
+    parser = argparse.ArgumentParser(
+        description="Noise spectrum and Allan deviation of a lock-in log.")
+    parser.add_argument('log', help="lock-in-*.log file")
+    parser.add_argument('file', nargs='?',
+                        help="output file for the power spectral density "
+                        "(frequency in Hz, PSD in V^2/Hz); if not given, write "
+                        "to stdout")
+    parser.add_argument('-a', '--allan', metavar='FILE',
+                        help="also write the Allan deviation (averaging time "
+                        "in s, deviation in V) to FILE")
+    parser.add_argument('-i', '--interval', type=float,
+                        help="sampling interval (in seconds) of the uniform "
+                        "grid; defaults to the median interval of the log")
+    parser.add_argument('-n', '--segment-length', type=int,
+                        default=SEGMENT_LENGTH,
+                        help="number of samples per Welch segment; defaults to "
+                        "%(default)s")
+    parser.add_argument('-j', '--processes', type=int,
+                        help="number of worker processes; defaults to the "
+                        "number of CPUs")
+    args = parser.parse_args()
+
+    try:
+        result = analyze(args.log, args.interval, args.segment_length,
+                         args.processes)
+    except (IOError, OSError, AssertionError) as err:
+        sys.stderr.write(type(err).__name__ + ": " + str(err) + "\n")
+        sys.stderr.write("error: invalid log file\n")
+        return
+    sys.stderr.write("sampling interval: %.4f s, %d samples, %d gaps\n" %
+                     (result['interval'], result['samples'], result['gaps']))
+    if len(result['deviations']):
+        optimum = np.argmin(result['deviations'])
+        tau = result['taus'][optimum]
+        sys.stderr.write("optimal averaging time: %.4g s (Allan deviation "
+                         "%.4E V)\n" % (tau, result['deviations'][optimum]))
+        sys.stderr.write("suggested lock-in time constant: %.4g s\n" %
+                         suggest_time_constant(tau))
+    if not len(result['psd']):
+        sys.stderr.write("warning: log shorter than one Welch segment\n")
+
+    try:
+        if args.file is None:
+            np.savetxt(sys.stdout, np.c_[result['frequencies'], result['psd']],
+                       fmt='%.6E', delimiter=',')
+        else:
+            np.savetxt(args.file, np.c_[result['frequencies'], result['psd']],
+                       fmt='%.6E', delimiter=',')
+        if args.allan is not None:
+            np.savetxt(args.allan, np.c_[result['taus'], result['deviations']],
+                       fmt='%.6E', delimiter=',')
+    except (IOError, OSError) as err:
+        sys.stderr.write(type(err).__name__ + ": " + str(err) + "\n")
+        sys.stderr.write("error: invalid output file\n")
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,9 @@ RX-202A (ruthenium oxide temperature sensor). Fitted curves (Chebychev series)
 are provided by Lake Shore, available at http://goo.gl/RchRMO . All coefficients
 can be found in 'RX202 curve.PDF' available from the aforementioned web page.
 
+A calibration refitted from curve data (see calibrate.py) can be loaded at
+runtime with load_calibration, replacing the vendor coefficients.
+
 When executed directly, this module takes resistance(s) as arguments and prints
 corresponding temperatures (scientific notation, four significant figures), one
 per line.
@@ -15,6 +18,8 @@ Functions:
 
     r2t(resistance): resistance to temperature
 
+    load_calibration(filename): load Chebychev series from a calibration file
+
 Constants:
 
     MIN_RESISTANCE: minimum resistance in the accepted range
@@ -27,6 +32,7 @@ Constants:
 from __future__ import print_function
 
 import argparse
+import json
 import math
 
 ################################## CONSTANTS ###################################
@@ -56,6 +62,15 @@ _ZL3 = 3.27800000000
 _ZU3 = 3.46671731726
 _RANGE_LOWER_LIMIT3 = 2243.15
 
+# (RANGE_LOWER_LIMIT, ZL, ZU, A, LOG_TEMPERATURE) of each temperature range, in
+# descending order of RANGE_LOWER_LIMIT, LOG_TEMPERATURE being True if the
+# series gives log10(T) rather than T; replaced by load_calibration
+_BANDS = [
+    (_RANGE_LOWER_LIMIT1, _ZL1, _ZU1, _A1, False),
+    (_RANGE_LOWER_LIMIT2, _ZL2, _ZU2, _A2, False),
+    (_RANGE_LOWER_LIMIT3, _ZL3, _ZU3, _A3, False),
+]
+
 ################################################################################
 
 def _chebychev_series(z, zl, zu, a):
@@ -84,12 +99,38 @@ def r2t(resistance):
         "resistance %.3e is out of range" % resistance
 
     z = math.log(resistance, 10)
-    if resistance >= _RANGE_LOWER_LIMIT1:
-        return _chebychev_series(z, _ZL1, _ZU1, _A1)
-    elif resistance >= _RANGE_LOWER_LIMIT2:
-        return _chebychev_series(z, _ZL2, _ZU2, _A2)
-    else:
-        return _chebychev_series(z, _ZL3, _ZU3, _A3)
+    for lower_limit, zl, zu, a, log_temperature in _BANDS:
+        if resistance >= lower_limit:
+            break
+    t = _chebychev_series(z, zl, zu, a)
+    return 10 ** t if log_temperature else t
+
+def load_calibration(filename):
+    """Load Chebychev series from a calibration file.
+
+    The calibration file is a JSON file as written by calibrate.py, with keys
+    'min_resistance', 'max_resistance' and 'bands', each band being a dict with
+    keys 'lower_limit', 'zl', 'zu' and 'coefficients', and optionally
+    'log_temperature' (true if the series gives log10(T) rather than T, as
+    fitted by calibrate.py; defaults to false). Loading replaces the vendor
+    coefficients and MIN_RESISTANCE and MAX_RESISTANCE for all subsequent
+    calls to r2t.
+
+    Return value is the decoded calibration (a dict).
+    """
+    global MIN_RESISTANCE, MAX_RESISTANCE, _BANDS
+    with open(filename) as calibration_file:
+        calibration = json.load(calibration_file)
+    bands = [(float(band['lower_limit']), float(band['zl']),
+              float(band['zu']), [float(a) for a in band['coefficients']],
+              bool(band.get('log_temperature', False)))
+             for band in calibration['bands']]
+    assert bands, "no temperature ranges in calibration %s" % filename
+    bands.sort(key=lambda band: band[0], reverse=True)
+    MIN_RESISTANCE = float(calibration['min_resistance'])
+    MAX_RESISTANCE = float(calibration['max_resistance'])
+    _BANDS = bands
+    return calibration
 
 ##################################### MAIN #####################################
 
@@ -99,7 +140,12 @@ def main():
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('resistances', type=float, nargs='+',
                         help='resistances in ohms; multiple values accepted')
+    parser.add_argument('-c', '--calibration',
+                        help='calibration file to use instead of the vendor '
+                        'coefficients')
     args = parser.parse_args()
+    if args.calibration is not None:
+        load_calibration(args.calibration)
     for resistance in args.resistances:
         print("%.3f" % r2t(resistance))
 
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+"""Replay recorded logs through the monitoring pipeline.
+
+A LogInstrument stands in for the pyvisa instrument inside gpib.PowerSupply
+or gpib.LockIn: it answers 'RDGI?' and 'RDGV?' (power supply) or 'OUTR? 1'
+(lock-in) with the data points of an existing power-supply-*.log or
+lock-in-*.log, and provides the clock used by the gpib instrument. The data
+points thus go through the same request pacing, retries, timing, conversion,
+console status, anomaly detection and output path as with the hardware.
+Replay can run in real time, at N times real time, or as fast as possible,
+which makes problematic runs reproducible and the end-to-end throughput of the
+pipeline measurable offline.
+
+The clock jumps from one logged request or reply time to the next, so that
+the original timestamps are reproduced exactly at any replay speed; the
+pacing of requests is that of the log, not the sampling interval of the gpib
+instrument. Unless replaying as fast as possible, each reading is answered
+when its logged reply time is due at the replay speed, counted from the start
+of the replay, so that delays do not accumulate.
+
+Malformed log lines are skipped with a note on stderr. The end of the log is
+signaled by EndOfReplay, which ends the monitor the way a keyboard interrupt
+does, i.e., saving the data points recorded.
+
+Classes:
+EndOfReplay: raised on a reading request past the end of the log
+LogInstrument: answer instrument queries from a log
+
+Functions:
+replay: replay a log through the matching monitor and return throughput
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+import warnings
+
+import anomaly
+import control
+import gpib
+import magnet
+import stream
+
+class EndOfReplay(KeyboardInterrupt):
+    """Raised on a reading request past the end of the log.
+
+    Derived from KeyboardInterrupt so that it is not retried by
+    gpib._GPIBInstrument.ask, and ends the monitors in control.py like the
+    keyboard interrupt they run until.
+    """
+
+    def __init__(self):
+        super(EndOfReplay, self).__init__("end of replay log")
+
+class LogInstrument(object):
+    """Answer instrument queries from a log.
+
+    Log lines hold the timestamp and the value, optionally followed by the
+    request-sent and reply-received times, the number of retries and the power
+    supply output voltage (see control._save_data).
+
+    Attributes:
+    speed: replay speed relative to real time; None for as fast as possible
+    """
+
+    # queries answered with the value of the next data point
+    _READING_QUERIES = ('RDGI?', 'OUTR? 1')
+
+    def __init__(self, logfilename, speed=1.0):
+        """LogInstrument class constructor.
+
+        Arguments:
+        logfilename: log file to replay
+        speed: replay speed relative to real time, e.g., 10.0 for ten times
+               faster; None or 0 for as fast as possible; defaults to 1.0
+        """
+        self.speed = speed or None
+        self._logfilename = logfilename
+        self._logfile = open(logfilename)
+        self._line_number = 0
+        self._current = None
+        self._next = self._read_data_point()
+        if self._next is None:
+            self._logfile.close()
+            raise ValueError("no data points in '%s'" % logfilename)
+        self._now = self._next['sent']
+        self._replied = False
+        self._start = None
+
+    def close(self):
+        """Close the log file."""
+        self._logfile.close()
+
+    def _read_data_point(self):
+        """Read the next data point from the log; None at the end."""
+        for line in self._logfile:
+            self._line_number += 1
+            if not line.strip():
+                continue
+            fields = line.strip().split(',')
+            try:
+                timestamp = float(fields[0])
+                float(fields[1])
+                if len(fields) >= 5:
+                    sent, received = float(fields[2]), float(fields[3])
+                else:
+                    sent = received = timestamp
+            except (ValueError, IndexError):
+                sys.stderr.write("%s:%d: skipping malformed line\n" %
+                                 (self._logfilename, self._line_number))
+                continue
+            return {'sent': sent, 'received': received, 'value': fields[1],
+                    'voltage': fields[5] if len(fields) >= 6 else None}
+        return None
+
+    def clock(self):
+        """Return the replay time, in seconds since the epoch of the log.
+
+        The first reading of the clock after a reply is the logged reply time,
+        and later readings are the logged request time of the next data point.
+        """
+        if self._replied:
+            self._replied = False
+        elif self._next is not None:
+            self._now = max(self._now, self._next['sent'])
+        return self._now
+
+    def ask(self, command):
+        """Answer a query, like pyvisa instrument.ask.
+
+        Reading queries advance to the next data point, and raise EndOfReplay
+        past the end of the log. 'RDGV?' is answered with the voltage of the
+        current data point, and fails (ValueError) if it was not recorded.
+        """
+        if command in self._READING_QUERIES:
+            if self._next is None:
+                raise EndOfReplay()
+            self._current = self._next
+            self._next = self._read_data_point()
+            if self.speed is not None:
+                if self._start is None:
+                    self._start = (time.time(), self._current['received'])
+                due = self._start[0] + (self._current['received'] -
+                                        self._start[1]) / self.speed
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            self._now = self._current['received']
+            self._replied = True
+            return self._current['value']
+        elif command == 'RDGV?':
+            if self._current is None or self._current['voltage'] is None or \
+               self._current['voltage'] == 'nan':
+                raise ValueError("voltage not recorded in the log")
+            return self._current['voltage']
+        raise ValueError("query '%s' not replayed" % command)
+
+    def write(self, command):
+        """Ignore a command, like pyvisa instrument.write."""
+        pass
+
+def replay(logfilename, output, speed=1.0, print_to_console=True,
+           detector=None, publisher=None):
+    """Replay a log through the matching monitor and return throughput.
+
+    The gpib instrument (gpib.PowerSupply or gpib.LockIn) and the monitor
+    (control.ps_monitor_current or control.li_monitor) are chosen by the log
+    file name, which must start with 'power-supply' or 'lock-in'.
+
+    Return value is a tuple (SAMPLES, SECONDS) of the number of data points
+    replayed and the wall-clock time taken, including writing the output.
+
+    Arguments:
+    logfilename: log file to replay
+    output: file object for writing output
+    speed: replay speed relative to real time; None or 0 for as fast as
+           possible; defaults to 1.0
+    print_to_console: if True, print status to stderr; defaults to True
+    detector: anomaly.AnomalyDetector instance; defaults to None
+    publisher: stream.Publisher instance; defaults to None
+    """
+    basename = os.path.basename(logfilename)
+    if basename.startswith('power-supply'):
+        instrument_class = gpib.PowerSupply
+        monitor = control.ps_monitor_current
+    elif basename.startswith('lock-in'):
+        instrument_class = gpib.LockIn
+        monitor = control.li_monitor
+    else:
+        raise ValueError("unknown log type '%s'" % basename)
+    log = LogInstrument(logfilename, speed)
+    try:
+        instrument = instrument_class(instrument=log, clock=log.clock)
+        # pacing is given by the logged request times
+        instrument.sampling_interval = 0
+        start = time.time()
+        with warnings.catch_warnings():
+            # failed reads are reported by the monitor already
+            warnings.simplefilter('ignore')
+            monitor(instrument, output, print_to_console, detector,
+                    publisher=publisher)
+    finally:
+        log.close()
+    return len(instrument.data), time.time() - start
+
+def main():
+    """CLI interface."""
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded log through the monitoring pipeline.")
+    parser.add_argument('log', help="power-supply-*.log or lock-in-*.log file")
+    parser.add_argument('file', nargs='?',
+                        help="output file; if not given, write to stdout")
+    speed = parser.add_mutually_exclusive_group()
+    speed.add_argument('-x', '--speed', type=float, default=1.0,
+                       help="replay speed relative to real time; defaults to "
+                       "%(default)s")
+    speed.add_argument('-f', '--fast', action='store_const', dest='speed',
+                       const=None, help="replay as fast as possible")
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="do not print status to the console")
+    parser.add_argument('-a', '--detect-anomalies', action='store_true',
+                        help="detect anomalies while replaying")
+    parser.add_argument('-p', '--publish', action='store_true',
+                        help="publish data points to live subscribers (see "
+                        "stream.py)")
+    args = parser.parse_args()
+    detector = None
+    if args.detect_anomalies:
+        detector = anomaly.AnomalyDetector(magnet.RAMP_SEGMENTS)
+    publisher = None
+    if args.publish:
+        basename = os.path.basename(args.log)
+        channel = 'lock-in' if basename.startswith('lock-in') \
+            else 'power-supply'
+        try:
+            publisher = stream.Publisher(channel)
+        except (IOError, OSError) as err:
+            sys.stderr.write(type(err).__name__ + ": " + str(err) + "\n")
+            sys.stderr.write("error: failed to start publisher\n")
+            return
+
+    try:
+        if args.file is None:
+            samples, seconds = replay(args.log, sys.stdout, args.speed,
+                                      not args.quiet, detector, publisher)
+        else:
+            with open(args.file, 'w') as output:
+                samples, seconds = replay(args.log, output, args.speed,
+                                          not args.quiet, detector, publisher)
+    except (IOError, OSError, ValueError) as err:
+        sys.stderr.write(type(err).__name__ + ": " + str(err) + "\n")
+        sys.stderr.write("error: invalid log or output file\n")
+        return
+    finally:
+        if publisher is not None:
+            publisher.close()
+    sys.stderr.write("replayed %d data points in %.3f s (%.1f per second)\n" %
+                     (samples, seconds, samples / seconds if seconds else 0))
+
+if __name__ == "__main__":
+    main()
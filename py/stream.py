@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+"""Local publish/subscribe streaming of live data points.
+
+The acquisition process publishes every data point (timestamp and value, as
+saved to the log) of a channel ('lock-in' or 'power-supply') in two ways:
+
+1. into a ring buffer in a memory-mapped file in the temporary directory,
+   which any number of subscribers can map and read from, e.g., to catch up
+   with the recent history when attaching;
+2. as a UDP datagram on localhost to every attached subscriber.
+
+Publishing never blocks the polling loop: the ring buffer is written in place,
+datagrams are sent with a non-blocking socket, and a data point that cannot be
+sent right away is dropped for that subscriber, who can recover it from the
+ring buffer. Subscribers attach and detach by sending 'subscribe' and
+'unsubscribe' datagrams to the publisher port.
+
+Every data point carries a sequence number (1 for the first data point of a
+run). A slot of the ring buffer is marked invalid while being written, so that
+readers never see a partially written data point.
+
+When executed directly, this module subscribes to a channel and prints data
+points to stdout as they arrive, in the format of the log files.
+
+Classes:
+Publisher: publish data points of a channel
+Subscriber: receive data points of a channel
+
+Constants:
+PORTS: default UDP ports (on localhost) of the channels
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import errno
+import mmap
+import os
+import socket
+import struct
+import sys
+import tempfile
+
+PORTS = {'lock-in': 50880, 'power-supply': 50881}
+
+# number of data points held by the ring buffer; 65536 data points last about
+# 1.8 hours at the default sampling rate of 10 Hz
+CAPACITY = 65536
+
+_HOST = '127.0.0.1'
+_HEADER = struct.Struct('<QQ')   # capacity, number of data points published
+_SLOT = struct.Struct('<Qdd')    # sequence number, timestamp, value
+_SEQUENCE = struct.Struct('<Q')  # sequence number at the start of a slot
+_SUBSCRIBE = b'subscribe'
+_UNSUBSCRIBE = b'unsubscribe'
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+def ring_path(channel):
+    """Return the path of the ring buffer file of a channel."""
+    return os.path.join(tempfile.gettempdir(), 'cryo-%s.ring' % channel)
+
+class Publisher(object):
+    """Publish data points of a channel.
+
+    Attributes:
+    channel: channel name, e.g., 'lock-in' or 'power-supply'
+    count: number of data points published
+    subscribers: set of subscriber addresses
+    """
+
+    def __init__(self, channel, port=None, capacity=CAPACITY):
+        """Publisher class constructor.
+
+        The ring buffer file of the channel is (re)created, discarding any data
+        points of a previous run, once the port is bound; if the port is in use
+        (e.g., by a live publisher of the channel), socket.error is raised and
+        the ring buffer is left alone.
+
+        Arguments:
+        channel: channel name
+        port: UDP port on localhost; defaults to PORTS[channel]
+        capacity: number of data points held by the ring buffer; defaults to
+                  CAPACITY
+        """
+        self.channel = channel
+        self.count = 0
+        self.subscribers = set()
+        self._capacity = capacity
+        # the port is bound first, so that a second publisher on a live
+        # channel fails before touching its ring buffer
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self._socket.bind((_HOST,
+                               port if port is not None else PORTS[channel]))
+        except socket.error:
+            self._socket.close()
+            raise
+        self._socket.setblocking(False)
+        size = _HEADER.size + capacity * _SLOT.size
+        with open(ring_path(channel), 'wb') as ring_file:
+            ring_file.truncate(size)
+        with open(ring_path(channel), 'r+b') as ring_file:
+            self._ring = mmap.mmap(ring_file.fileno(), size)
+        _HEADER.pack_into(self._ring, 0, capacity, 0)
+
+    def close(self):
+        """Close the socket and the ring buffer; the file is left in place."""
+        self._socket.close()
+        self._ring.close()
+
+    def _update_subscribers(self):
+        """Process pending subscribe and unsubscribe requests."""
+        while True:
+            try:
+                request, address = self._socket.recvfrom(64)
+            except socket.error as err:
+                if err.errno in _WOULD_BLOCK:
+                    return
+                # e.g., ICMP port unreachable from a vanished subscriber on
+                # Windows; nothing to do
+                continue
+            if request == _SUBSCRIBE:
+                self.subscribers.add(address)
+            elif request == _UNSUBSCRIBE:
+                self.subscribers.discard(address)
+
+    def publish(self, timestamp, value):
+        """Publish a data point, without blocking."""
+        self.count += 1
+        offset = _HEADER.size + (self.count - 1) % self._capacity * _SLOT.size
+        # the slot is invalid (sequence number 0) while being written
+        _SLOT.pack_into(self._ring, offset, 0, timestamp, value)
+        _SEQUENCE.pack_into(self._ring, offset, self.count)
+        _HEADER.pack_into(self._ring, 0, self._capacity, self.count)
+
+        self._update_subscribers()
+        packet = _SLOT.pack(self.count, timestamp, value)
+        for address in list(self.subscribers):
+            try:
+                self._socket.sendto(packet, address)
+            except socket.error as err:
+                if err.errno not in _WOULD_BLOCK:
+                    self.subscribers.discard(address)
+
+class Subscriber(object):
+    """Receive data points of a channel.
+
+    Data points are tuples (SEQUENCE, TIMESTAMP, VALUE). Data points missed on
+    the socket are recovered from the ring buffer, as long as they have not
+    been overwritten.
+
+    Attributes:
+    channel: channel name
+    last: sequence number of the last data point returned
+    """
+
+    def __init__(self, channel, port=None):
+        """Subscriber class constructor.
+
+        Attaches to a running publisher. Data points published before
+        attaching, as far as still held by the ring buffer, are returned by
+        catch_up; read skips them.
+
+        Arguments:
+        channel: channel name
+        port: UDP port of the publisher; defaults to PORTS[channel]
+        """
+        self.channel = channel
+        with open(ring_path(channel), 'rb') as ring_file:
+            self._ring = mmap.mmap(ring_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        self._capacity, self._attached = _HEADER.unpack_from(self._ring, 0)
+        # catch_up starts from the oldest data point in the ring buffer
+        self.last = max(0, self._attached - self._capacity)
+        self._publisher = (_HOST, port if port is not None else PORTS[channel])
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((_HOST, 0))
+        self._socket.sendto(_SUBSCRIBE, self._publisher)
+
+    def close(self):
+        """Detach from the publisher."""
+        try:
+            self._socket.sendto(_UNSUBSCRIBE, self._publisher)
+        except socket.error:
+            pass
+        self._socket.close()
+        self._ring.close()
+
+    def _ring_data_points(self, start, stop):
+        """Read data points with sequence numbers in [start, stop) from the ring
+        buffer, skipping any that have been overwritten."""
+        data_points = []
+        for sequence in range(max(start, stop - self._capacity), stop):
+            offset = _HEADER.size + (sequence - 1) % self._capacity * _SLOT.size
+            if _SEQUENCE.unpack_from(self._ring, offset)[0] != sequence:
+                continue
+            data_point = _SLOT.unpack_from(self._ring, offset)
+            # the sequence number is re-read to detect a concurrent write
+            if _SEQUENCE.unpack_from(self._ring, offset)[0] == sequence:
+                data_points.append(data_point)
+        return data_points
+
+    def catch_up(self):
+        """Return the data points in the ring buffer since the last one
+        returned, i.e., on the first call, those published before attaching
+        and since."""
+        count = _HEADER.unpack_from(self._ring, 0)[1]
+        data_points = self._ring_data_points(self.last + 1, count + 1)
+        if data_points:
+            self.last = data_points[-1][0]
+        return data_points
+
+    def read(self, timeout=None):
+        """Return new data points.
+
+        Waits up to timeout seconds (forever if None) for the first datagram,
+        then returns it along with any datagrams already pending. Gaps in the
+        sequence are filled from the ring buffer.
+        """
+        packets = []
+        self._socket.settimeout(timeout)
+        try:
+            packets.append(self._socket.recv(_SLOT.size))
+            self._socket.setblocking(False)
+            while True:
+                packets.append(self._socket.recv(_SLOT.size))
+        except socket.timeout:
+            pass
+        except socket.error as err:
+            if err.errno not in _WOULD_BLOCK:
+                raise
+
+        # data points published before attaching are left to catch_up
+        self.last = max(self.last, self._attached)
+        data_points = []
+        for packet in packets:
+            data_point = _SLOT.unpack(packet)
+            sequence = data_point[0]
+            if sequence <= self.last:
+                continue
+            data_points.extend(self._ring_data_points(self.last + 1, sequence))
+            data_points.append(data_point)
+            self.last = sequence
+        return data_points
+
+def main():
+    """CLI interface."""
+    parser = argparse.ArgumentParser(
+        description="Print live data points published by control.py.")
+    parser.add_argument('channel', choices=sorted(PORTS),
+                        help="channel to subscribe to")
+    parser.add_argument('-p', '--port', type=int,
+                        help="UDP port of the publisher; defaults to %s" %
+                        ", ".join("%d for %s" % (PORTS[channel], channel)
+                                  for channel in sorted(PORTS)))
+    parser.add_argument('-c', '--catch-up', action='store_true',
+                        help="print the data points in the ring buffer first")
+    args = parser.parse_args()
+
+    try:
+        subscriber = Subscriber(args.channel, args.port)
+    except (IOError, OSError) as err:
+        sys.stderr.write(type(err).__name__ + ": " + str(err) + "\n")
+        sys.stderr.write("error: no publisher for channel %s\n" % args.channel)
+        return
+    value_format = "%.4E" if args.channel == 'lock-in' else "%.4f"
+    try:
+        if args.catch_up:
+            data_points = subscriber.catch_up()
+        else:
+            data_points = []
+        while True:
+            for _, timestamp, value in data_points:
+                sys.stdout.write(("%.4f," + value_format + "\n") %
+                                 (timestamp, value))
+            sys.stdout.flush()
+            data_points = subscriber.read()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        subscriber.close()
+
+if __name__ == "__main__":
+    main()
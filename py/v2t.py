@@ -16,6 +16,10 @@ mimic the behavior of a standard thermometer.
 
 In the end, the normalized resistance is fed into r2t to get the measured
 temperature.
+
+A calibration file written by calibrate.py can be loaded with load_calibration;
+it replaces the Chebychev series used by r2t and, if fitted from reference
+points, SCALING_FACTOR.
 """
 
 from __future__ import division
@@ -24,6 +28,7 @@ from __future__ import print_function
 import argparse
 
 from r2t import r2t
+from r2t import load_calibration as _load_curve
 
 V_EMS = 1E-2
 R_LARGE = 1.5E6
@@ -61,13 +66,29 @@ def v2t(v_therm):
     r_therm_std = r_therm * SCALING_FACTOR
     return r2t(r_therm_std)
 
+def load_calibration(filename):
+    """Load a calibration file written by calibrate.py.
+
+    See r2t.load_calibration. If the calibration has a 'scaling_factor' key,
+    SCALING_FACTOR is replaced as well.
+    """
+    global SCALING_FACTOR
+    calibration = _load_curve(filename)
+    if calibration.get('scaling_factor') is not None:
+        SCALING_FACTOR = float(calibration['scaling_factor'])
+    return calibration
+
 def main():
     """CLI interface."""
     description = 'Compute temperature from voltage across the thermometer.'
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('voltages', type=float, nargs='+',
                         help='voltages in volts; multiple values accepted')
+    parser.add_argument('-c', '--calibration',
+                        help='calibration file written by calibrate.py')
     args = parser.parse_args()
+    if args.calibration is not None:
+        load_calibration(args.calibration)
     for voltage in args.voltages:
         print("%.3f" % v2t(voltage))
 